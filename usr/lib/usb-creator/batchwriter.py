@@ -0,0 +1,327 @@
+#! /usr/bin/env python3
+
+# Write the same ISOs to several USB devices at once.
+# The devices are prepared (format, bootloaders) by the usb-creator backend
+# in parallel. Each ISO is then read once into a bounded ring buffer and
+# written to all devices at the same time (see fanout.py). Finally Grub is
+# configured and the copies are verified.
+# A failing device is dropped from the batch without stopping the others.
+#
+# Command line usage (the backend calls this for -a or a comma separated -d):
+# batchwriter.py [-f] [-r] [-s] [-l LABEL] [--history FILE] [--cache FILE]
+#                [--chunk-size MB] [--chunks N]
+#                (--all | /dev/sdb /dev/sdc ...) -i "/path/to/your.iso" [...]
+
+import os
+import sys
+import argparse
+import subprocess
+import threading
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists, basename, join, isdir
+from copyengine import sha256_file, print_progress
+from digestcache import DigestCache
+from fanout import FanoutCopier, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNKS
+from progress import ProgressWriter
+from utils import get_partition_path
+
+# Backend exit codes used by the batch writer
+EXIT_DEVICE = 3
+EXIT_ISO = 4
+EXIT_MOUNT = 6
+EXIT_MISMATCH = 7
+EXIT_SPACE = 10
+EXIT_COPY = 12
+
+
+# Return all removable USB drives known to UDisks2
+def get_usb_drives():
+    from udisks2 import Udisks2
+    udisks2 = Udisks2()
+    udisks2.fill_devices(flash_only=True)
+    return udisks2.get_drives()
+
+
+# Return the mount point of a partition or an empty string
+def get_mount_point(partition):
+    with open('/proc/mounts', 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 1 and fields[0] == partition:
+                return fields[1].replace('\\040', ' ')
+    return ''
+
+
+class BatchWriter():
+    def __init__(self, devices, isos, format_device=False, repair=False, verify=False,
+                 label='', cache_path=None, history_path=None,
+                 max_parallel=None, progress_callback=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, chunks=DEFAULT_CHUNKS):
+        self.devices = list(devices)
+        self.isos = list(isos)
+        self.format_device = format_device
+        self.repair = repair
+        self.verify = verify
+        self.label = label
+        self.cache_path = cache_path
+        self.history_path = history_path
+        self.max_parallel = max_parallel or len(self.devices) or 1
+        # Called with (device, event dictionary)
+        self.progress_callback = progress_callback
+        # Per device: phase, exit code and mount point
+        self.status = {}
+        self.lock = threading.Lock()
+        self.copier = FanoutCopier(chunk_size=chunk_size, chunks=chunks,
+                                   progress_callback=self.on_copy_progress,
+                                   hash_source=verify)
+        # Source digests computed while copying
+        self.digests = {}
+        # Stat keys of the sources when their copy started
+        self.digest_keys = {}
+        # Ring buffer statistics per ISO
+        self.copy_stats = {}
+        for device in self.devices:
+            self.status[device] = {'phase': 'waiting', 'exit_code': 0, 'mount': ''}
+
+    # Run all phases and return a dictionary with the exit code per device
+    def run(self):
+        self.run_phase('prepare', self.prepare_device)
+        for iso in self.isos:
+            self.copy_iso(iso)
+        self.add_to_history()
+        self.run_phase('grub', self.configure_grub)
+        if self.verify:
+            self.verify_isos()
+        for device in self.active_devices():
+            self.set_phase(device, 'done')
+        return dict((device, status['exit_code']) for device, status in self.status.items())
+
+    def active_devices(self):
+        return [d for d in self.devices if self.status[d]['exit_code'] == 0]
+
+    def run_phase(self, phase, func, *args):
+        devices = self.active_devices()
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as pool:
+            for device in devices:
+                self.set_phase(device, phase)
+                pool.submit(self._run_isolated, device, func, device, *args)
+
+    # Exceptions only fail the device they belong to
+    def _run_isolated(self, device, func, *args):
+        try:
+            ret = func(*args)
+        except Exception as e:
+            self.emit(device, {'event': 'error', 'phase': self.status[device]['phase'], 'message': str(e)})
+            ret = EXIT_COPY
+        if ret:
+            self.fail(device, ret)
+
+    def fail(self, device, exit_code):
+        with self.lock:
+            if self.status[device]['exit_code'] == 0:
+                self.status[device]['exit_code'] = exit_code
+        self.emit(device, {'event': 'failed', 'phase': self.status[device]['phase'], 'exit_code': exit_code})
+
+    def set_phase(self, device, phase):
+        self.status[device]['phase'] = phase
+        self.emit(device, {'event': 'phase', 'phase': phase})
+
+    def emit(self, device, event):
+        if self.progress_callback is not None:
+            with self.lock:
+                self.progress_callback(device, event)
+
+    def backend(self, device, arguments):
+        cmd = ['usb-creator', '-d', device] + arguments
+        if self.label:
+            cmd += ['-l', self.label]
+        return subprocess.call(cmd, stdout=subprocess.DEVNULL)
+
+    # Format and install the bootloaders
+    def prepare_device(self, device):
+        arguments = []
+        if self.format_device:
+            arguments += ['-f', '-b']
+        if self.repair:
+            arguments += ['-r', '-b']
+        ret = self.backend(device, arguments)
+        if ret == 0:
+            partition = get_partition_path(device)
+            mount = get_mount_point(partition)
+            if mount == '':
+                subprocess.call(['udisksctl', 'mount', '-b', partition], stdout=subprocess.DEVNULL)
+                mount = get_mount_point(partition)
+            if mount == '':
+                return EXIT_MOUNT
+            self.status[device]['mount'] = mount
+        return ret
+
+    # Read one ISO once and write it to all devices at the same time
+    def copy_iso(self, iso):
+        size = os.path.getsize(iso)
+        devices = []
+        for device in self.active_devices():
+            mount = self.status[device]['mount']
+            st = os.statvfs(mount)
+            free = st.f_bavail * st.f_frsize
+            target = join(mount, basename(iso))
+            if exists(target):
+                free += os.path.getsize(target)
+            if size > free:
+                self.fail(device, EXIT_SPACE)
+            else:
+                devices.append(device)
+        if not devices:
+            return
+
+        targets = {}
+        for device in devices:
+            self.set_phase(device, 'copy')
+            targets[join(self.status[device]['mount'], basename(iso))] = device
+        self.copy_targets = targets
+        try:
+            errors = self.copier.copy(iso, list(targets.keys()))
+        except OSError as e:
+            # The source could not be read: all devices fail
+            errors = dict((target, e) for target in targets)
+        for target, error in errors.items():
+            if error is not None:
+                self.emit(targets[target], {'event': 'error', 'phase': 'copy', 'message': str(error)})
+                self.fail(targets[target], EXIT_COPY)
+        # Only keep the digest (it goes into the digest cache) when a device got the ISO
+        copied = [target for target, error in errors.items() if error is None]
+        if copied and self.copier.source_digest is not None:
+            self.digests[iso] = self.copier.source_digest
+            self.digest_keys[iso] = self.copier.source_key
+        self.copy_stats[iso] = dict(self.copier.stats)
+
+    def on_copy_progress(self, target, event):
+        self.emit(self.copy_targets[target], event)
+
+    def configure_grub(self, device):
+        return self.backend(device, ['-g'])
+
+    # Hash the sources once and read back every device
+    def verify_isos(self):
+        cache = DigestCache(self.cache_path) if self.cache_path else None
+        digests = {}
+        for iso in self.isos:
+            if iso in self.digests:
+                # Hashed while copying
+                digests[iso] = self.digests[iso]
+                if cache is not None:
+                    cache.put(iso, digests[iso], self.digest_keys[iso])
+            else:
+                digests[iso] = cache.sha256(iso) if cache else sha256_file(iso)
+
+        def verify_device(device):
+            for iso in self.isos:
+                target = join(self.status[device]['mount'], basename(iso))
+                if sha256_file(target, direct=True) != digests[iso]:
+                    self.emit(device, {'event': 'mismatch', 'phase': 'verify', 'source': iso})
+                    return EXIT_MISMATCH
+            return 0
+
+        self.run_phase('verify', verify_device)
+
+    def add_to_history(self):
+        if not self.history_path or not self.active_devices():
+            return
+        history = []
+        if exists(self.history_path):
+            with open(self.history_path, 'r') as f:
+                history = [line.strip() for line in f]
+        with open(self.history_path, 'a') as f:
+            for iso in self.isos:
+                if iso not in history:
+                    f.write(iso + '\n')
+
+
+def print_device_progress(device, event):
+    name = basename(device)
+    if event['event'] in ('start', 'progress', 'done'):
+        sys.stdout.write("[{}] ".format(name))
+        print_progress(event)
+    elif event['event'] == 'phase':
+        print(("[{}] Phase: {}".format(name, event['phase'])))
+    elif event['event'] == 'error':
+        print(("[{}] Error in {}: {}".format(name, event['phase'], event['message'])))
+    elif event['event'] == 'failed':
+        print(("[{}] Failed in {} with exit code {}".format(name, event['phase'], event['exit_code'])))
+    elif event['event'] == 'mismatch':
+        print(("[{}] sha256sum of {} does NOT match original".format(name, event['source'])))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write ISOs to several USB devices at once.')
+    parser.add_argument('-f', dest='format_device', action='store_true', help='Format the devices')
+    parser.add_argument('-r', dest='repair', action='store_true', help='Repair the devices')
+    parser.add_argument('-s', dest='verify', action='store_true', help='sha256sum the ISOs')
+    parser.add_argument('-l', dest='label', default='', help='Label of the USB devices')
+    parser.add_argument('-i', dest='isos', nargs='+', default=[], help='The ISOs to add')
+    parser.add_argument('--all', action='store_true', help='Use all removable USB devices')
+    parser.add_argument('--cache', help='Digest cache file of the source ISOs')
+    parser.add_argument('--history', help='ISO history file')
+    parser.add_argument('--max-parallel', type=int, default=None,
+                        help='Maximum number of devices prepared at the same time')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE // 1048576,
+                        help='Size of a ring buffer chunk in MB')
+    parser.add_argument('--chunks', type=int, default=DEFAULT_CHUNKS,
+                        help='Number of chunks in the ring buffer')
+    parser.add_argument('devices', nargs='*')
+    args = parser.parse_args()
+
+    devices = args.devices
+    if args.all:
+        devices = get_usb_drives()
+    devices = [d for d in devices if exists(d)]
+    if not devices:
+        print("No devices found.")
+        return EXIT_DEVICE
+
+    isos = []
+    for iso in args.isos:
+        if isdir(iso):
+            isos += sorted(glob(join(iso, '*.iso')))
+        elif exists(iso):
+            isos.append(iso)
+        else:
+            print(("{} does not exist.".format(iso)))
+            return EXIT_ISO
+
+    print(("Batch write to: {}".format(', '.join(devices))))
+    channel = ProgressWriter.from_environment()
+
+    def report(device, event):
+        print_device_progress(device, event)
+        record = dict(event)
+        record['device'] = device
+        channel.emit(record)
+    writer = BatchWriter(devices, isos,
+                         format_device=args.format_device,
+                         repair=args.repair,
+                         verify=args.verify,
+                         label=args.label,
+                         cache_path=args.cache,
+                         history_path=args.history,
+                         max_parallel=args.max_parallel,
+                         progress_callback=report,
+                         chunk_size=args.chunk_size * 1048576,
+                         chunks=args.chunks)
+    results = writer.run()
+    for iso, stats in writer.copy_stats.items():
+        print(("Ring buffer of {}: {} MB, high-water mark: {} MB, reader stalled: {:.1f} s".format(
+               basename(iso), int(stats['buffer_size'] / 1048576),
+               int(stats['high_water_mark'] / 1048576), stats['reader_stall_time'])))
+    ret = 0
+    for device in devices:
+        print(("[{}] Exit code: {}".format(basename(device), results[device])))
+        if results[device] and not ret:
+            ret = results[device]
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,376 @@
+#! /usr/bin/env python3
+
+# Tell which Grub targets need to be (re)installed on a USB.
+# After grub-install the state of every target is recorded on the stick
+# (boot/grub/usb-creator-boot.json): a fingerprint of the host's Grub build
+# for that target and hashes of what was installed (MBR boot code, core.img,
+# EFI binaries and the module directory). A target only needs to be
+# installed when it is missing, was changed or the host's Grub changed.
+#
+# Instead of running grub-install for every stick, the bootloaders are built
+# once per host Grub build into a cache (/var/cache/usb-creator/grub).
+# The EFI images carry their modules and the font in a memdisk, so an EFI
+# target is a single file on the stick. Like grub-install, the images find
+# the stick by the UUID of its file system (with several sticks plugged in,
+# a stick never boots with the files of another): the cached EFI images hold
+# a placeholder that is replaced by the UUID while copying. core.img of
+# i386-pc is compressed and has to fit in front of the first partition, so
+# it is built for every stick with grub-mkimage and its module tree is
+# copied; grub-bios-setup then writes the MBR and embeds core.img.
+#
+# Command line usage (used by the usb-creator backend):
+# bootloader.py check --device /dev/sdb --mount /mount/point
+# bootloader.py targets
+# bootloader.py install --device /dev/sdb --mount /mount/point TARGET [...]
+# bootloader.py record --device /dev/sdb --mount /mount/point TARGET [...]
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import tarfile
+import tempfile
+import subprocess
+from glob import glob
+from os.path import join, exists, isdir, dirname, basename
+
+STATE_NAME = 'usb-creator-boot.json'
+HOST_GRUB_DIR = '/usr/lib/grub'
+# Boot code of the MBR (before the disk signature and partition table)
+MBR_BOOT_CODE = 440
+
+# Target -> files installed on the USB (relative to the mount point)
+TARGETS = {'i386-efi': ['EFI/BOOT/BOOTIA32.EFI'],
+           'x86_64-efi': ['EFI/BOOT/BOOTX64.EFI'],
+           'i386-pc': ['boot/grub/i386-pc/core.img']}
+# Order in which the targets are installed
+TARGET_ORDER = ['i386-efi', 'x86_64-efi', 'i386-pc']
+
+PAYLOAD_CACHE_DIR = '/var/cache/usb-creator/grub'
+# Change when the layout of the payload changes
+PAYLOAD_VERSION = 3
+FONT_FILE = '/usr/share/grub/unicode.pf2'
+EFI_MODULES = ['part_gpt', 'part_msdos', 'fat', 'search_fs_uuid', 'memdisk', 'tar', 'normal', 'configfile']
+# Target -> (image, modules built into the image)
+IMAGE_MODULES = {'i386-efi': ('EFI/BOOT/BOOTIA32.EFI', EFI_MODULES),
+                 'x86_64-efi': ('EFI/BOOT/BOOTX64.EFI', EFI_MODULES),
+                 'i386-pc': ('boot/grub/i386-pc/core.img', ['biosdisk', 'part_msdos', 'fat', 'search_fs_uuid'])}
+# Targets that load their modules from the stick
+MODULE_TARGETS = ['i386-pc']
+# Configuration built into the images: find the stick by its file system UUID
+# The modules of the EFI images are in their memdisk
+EARLY_CONFIG = '''search.fs_uuid {} root
+set prefix=($root)/boot/grub
+'''
+EFI_EARLY_CONFIG = '''search.fs_uuid {} root
+set prefix=(memdisk)/boot/grub
+'''
+# grub.cfg in the memdisk: go on with the one on the stick
+MEMDISK_CONFIG = '''configfile ($root)/boot/grub/grub.cfg
+'''
+# Stands for the UUID in the cached EFI images (a UUID has at most 36 characters)
+UUID_PLACEHOLDER = 'usb-creator-uuid-placeholder-0000000'
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(1048576), b''):
+            sha.update(data)
+    return sha.hexdigest()
+
+
+# Hash of the names and sizes of the files in a directory (no file is read)
+def hash_listing(path):
+    sha = hashlib.sha256()
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if entry.is_file():
+            sha.update('{}:{}\n'.format(entry.name, entry.stat().st_size).encode('utf-8'))
+    return sha.hexdigest()
+
+
+# Fingerprint of the host's Grub build of a target or None when it is not installed
+def host_fingerprint(target, grub_dir=HOST_GRUB_DIR):
+    target_dir = join(grub_dir, target)
+    if not isdir(target_dir):
+        return None
+    # modinfo.sh holds the version and build of the target
+    modinfo = join(target_dir, 'modinfo.sh')
+    if exists(modinfo):
+        return hash_file(modinfo)
+    return hash_listing(target_dir)
+
+
+# Return the UUID of the file system mounted on mount or None
+def get_fs_uuid(mount):
+    partition = ''
+    try:
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1 and fields[1].replace('\\040', ' ') == mount:
+                    partition = os.path.realpath(fields[0])
+        by_uuid = '/dev/disk/by-uuid'
+        if partition and isdir(by_uuid):
+            for name in os.listdir(by_uuid):
+                if os.path.realpath(join(by_uuid, name)) == partition:
+                    return name
+    except OSError:
+        pass
+    return None
+
+
+# Hashes of what is installed on the USB for a target or None when something is missing
+def installed_state(target, mount, device=None):
+    state = {}
+    for name in TARGETS[target]:
+        path = join(mount, name)
+        if not exists(path):
+            return None
+        state[name] = hash_file(path)
+    if target in MODULE_TARGETS:
+        module_dir = join(mount, 'boot', 'grub', target)
+        if not isdir(module_dir):
+            return None
+        state['modules'] = hash_listing(module_dir)
+    if target == 'i386-pc':
+        if device is None:
+            return None
+        with open(device, 'rb') as f:
+            boot_code = f.read(MBR_BOOT_CODE)
+        if b'GRUB' not in boot_code:
+            return None
+        state['mbr'] = hashlib.sha256(boot_code).hexdigest()
+    return state
+
+
+# Return the payload directory of the host's Grub build, built when missing
+# Returns None when the payload cannot be built (grub-mkimage missing, ...)
+def get_payload(cache_dir=PAYLOAD_CACHE_DIR, grub_dir=HOST_GRUB_DIR):
+    sha = hashlib.sha256(str(PAYLOAD_VERSION).encode())
+    for target in TARGET_ORDER:
+        sha.update(str(host_fingerprint(target, grub_dir)).encode())
+    payload = join(cache_dir, sha.hexdigest()[:16])
+    if isdir(payload):
+        return payload
+
+    if not isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_dir = tempfile.mkdtemp(prefix='.build-', dir=cache_dir)
+    try:
+        # Module tree (for the stick or the memdisk) and font
+        tree = join(tmp_dir, 'tree')
+        for target in TARGET_ORDER:
+            source = join(grub_dir, target)
+            if not isdir(source):
+                continue
+            modules = join(tree, 'boot', 'grub', target)
+            os.makedirs(modules)
+            for path in glob(join(source, '*.mod')) + glob(join(source, '*.lst')) + glob(join(source, '*.img')):
+                shutil.copyfile(path, join(modules, basename(path)))
+        if exists(FONT_FILE):
+            os.makedirs(join(tree, 'boot', 'grub', 'fonts'))
+            shutil.copyfile(FONT_FILE, join(tree, 'boot', 'grub', 'fonts', basename(FONT_FILE)))
+        for target in TARGET_ORDER:
+            if target not in MODULE_TARGETS and isdir(join(tree, 'boot', 'grub', target)):
+                build_efi_image(target, tree, join(tmp_dir, IMAGE_MODULES[target][0]), grub_dir)
+        # Only the targets that load modules from the stick keep their tree
+        for target in TARGET_ORDER:
+            if target not in MODULE_TARGETS and isdir(join(tree, 'boot', 'grub', target)):
+                shutil.rmtree(join(tree, 'boot', 'grub', target))
+        os.rename(join(tree, 'boot'), join(tmp_dir, 'boot'))
+        shutil.rmtree(tree)
+        try:
+            os.rename(tmp_dir, payload)
+        except OSError:
+            # Built at the same time by another process
+            if not isdir(payload):
+                raise
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    finally:
+        if isdir(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return payload
+
+
+# Build the boot image of a target that finds the file system with this UUID
+def build_image(target, uuid, image, grub_dir=HOST_GRUB_DIR):
+    if not isdir(dirname(image)):
+        os.makedirs(dirname(image))
+    with tempfile.NamedTemporaryFile('w', prefix='usb-creator-', suffix='.cfg') as config:
+        config.write(EARLY_CONFIG.format(uuid))
+        config.flush()
+        subprocess.check_call(['grub-mkimage', '-O', target, '-d', join(grub_dir, target), '-c', config.name,
+                               '-p', '/boot/grub', '-o', image] + IMAGE_MODULES[target][1])
+
+
+# Build an EFI image with the modules and font of tree in its memdisk
+# The UUID in its configuration is UUID_PLACEHOLDER
+def build_efi_image(target, tree, image, grub_dir=HOST_GRUB_DIR):
+    if not isdir(dirname(image)):
+        os.makedirs(dirname(image))
+    work_dir = tempfile.mkdtemp(prefix='.memdisk-', dir=dirname(tree))
+    try:
+        memdisk = join(work_dir, 'memdisk.tar')
+        with tarfile.open(memdisk, 'w', format=tarfile.USTAR_FORMAT) as tar:
+            tar.add(join(tree, 'boot', 'grub', target), arcname='boot/grub/{}'.format(target))
+            if isdir(join(tree, 'boot', 'grub', 'fonts')):
+                tar.add(join(tree, 'boot', 'grub', 'fonts'), arcname='boot/grub/fonts')
+            config = join(work_dir, 'grub.cfg')
+            with open(config, 'w') as f:
+                f.write(MEMDISK_CONFIG)
+            tar.add(config, arcname='boot/grub/grub.cfg')
+        config = join(work_dir, 'early.cfg')
+        with open(config, 'w') as f:
+            f.write(EFI_EARLY_CONFIG.format(UUID_PLACEHOLDER))
+        subprocess.check_call(['grub-mkimage', '-O', target, '-d', join(grub_dir, target), '-c', config,
+                               '-m', memdisk, '-p', '(memdisk)/boot/grub', '-o', image] + IMAGE_MODULES[target][1])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# Copy a cached EFI image to the USB with the UUID of its file system
+# Returns False when the placeholder is not found once in the image
+def copy_efi_image(source, image, uuid):
+    placeholder = UUID_PLACEHOLDER.encode()
+    with open(source, 'rb') as f:
+        data = f.read()
+    if data.count(placeholder) != 1 or len(uuid) > len(placeholder):
+        return False
+    # Padded with spaces: the configuration is not compressed and keeps its size
+    data = data.replace(placeholder, uuid.encode().ljust(len(placeholder)))
+    if not isdir(dirname(image)):
+        os.makedirs(dirname(image))
+    with open(image, 'wb') as f:
+        f.write(data)
+    return True
+
+
+# Copy the files of a payload directory to the USB
+def copy_tree(source, destination):
+    for root, dirs, files in os.walk(source):
+        target_dir = join(destination, os.path.relpath(root, source))
+        if not isdir(target_dir):
+            os.makedirs(target_dir)
+        for name in files:
+            shutil.copyfile(join(root, name), join(target_dir, name))
+
+
+class BootloaderState():
+    def __init__(self, mount, device=None, grub_dir=HOST_GRUB_DIR):
+        self.mount = mount
+        self.device = device
+        self.grub_dir = grub_dir
+        self.state_path = join(mount, 'boot', 'grub', STATE_NAME)
+        self.uuid = get_fs_uuid(mount)
+
+    def load(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    # Return the targets that are missing or out of date
+    def check(self, targets=TARGET_ORDER):
+        recorded = self.load()
+        needed = []
+        for target in targets:
+            entry = recorded.get(target)
+            try:
+                current = installed_state(target, self.mount, self.device)
+            except OSError:
+                # The stick or the device cannot be read: install the target again
+                current = None
+            if entry is None or current is None or \
+               entry.get('host') != host_fingerprint(target, self.grub_dir) or \
+               entry.get('uuid') != self.uuid or \
+               entry.get('installed') != current:
+                needed.append(target)
+        return needed
+
+    # Install targets from the payload cache and record them
+    # Returns False when the payload cannot be used (use grub-install then)
+    def install(self, targets, cache_dir=PAYLOAD_CACHE_DIR):
+        payload = get_payload(cache_dir, self.grub_dir)
+        if payload is None or self.uuid is None:
+            return False
+        for target in targets:
+            image = IMAGE_MODULES[target][0]
+            if target in MODULE_TARGETS:
+                if not isdir(join(payload, 'boot', 'grub', target)):
+                    return False
+                copy_tree(join(payload, 'boot', 'grub', target), join(self.mount, 'boot', 'grub', target))
+                try:
+                    build_image(target, self.uuid, join(self.mount, image), self.grub_dir)
+                except (OSError, subprocess.CalledProcessError):
+                    return False
+            elif not exists(join(payload, image)) or \
+                 not copy_efi_image(join(payload, image), join(self.mount, image), self.uuid):
+                return False
+        # The EFI images have the font in their memdisk
+        if [t for t in targets if t in MODULE_TARGETS] and exists(join(payload, 'boot', 'grub', 'fonts')):
+            copy_tree(join(payload, 'boot', 'grub', 'fonts'), join(self.mount, 'boot', 'grub', 'fonts'))
+        self.record(targets)
+        if 'i386-pc' in targets:
+            # Write boot.img to the MBR and embed core.img after it
+            try:
+                subprocess.check_call(['grub-bios-setup', '-d', join(self.mount, 'boot', 'grub', 'i386-pc'),
+                                       self.device])
+            except (OSError, subprocess.CalledProcessError):
+                return False
+            self.record(['i386-pc'])
+        return True
+
+    # Record the state of freshly installed targets
+    def record(self, targets):
+        recorded = self.load()
+        for target in targets:
+            current = installed_state(target, self.mount, self.device)
+            if current is None:
+                recorded.pop(target, None)
+            else:
+                recorded[target] = {'host': host_fingerprint(target, self.grub_dir),
+                                    'uuid': self.uuid,
+                                    'installed': current}
+        if not isdir(dirname(self.state_path)):
+            return
+        tmp_path = '{}.tmp'.format(self.state_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(recorded, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check or record the Grub targets installed on a USB.')
+    parser.add_argument('action', choices=['check', 'install', 'record', 'targets'])
+    parser.add_argument('--device', help='Device of the USB (for the MBR)')
+    parser.add_argument('--mount', help='Mount point of the USB')
+    parser.add_argument('targets', nargs='*')
+    args = parser.parse_args()
+
+    if args.action == 'targets':
+        # Print all targets (installed when check fails)
+        print((' '.join(TARGET_ORDER)))
+        return 0
+    if not args.mount:
+        parser.error('--mount is required')
+    state = BootloaderState(args.mount, args.device)
+    targets = args.targets or TARGET_ORDER
+    if args.action == 'check':
+        # Print the targets that need to be installed
+        print((' '.join(state.check(targets))))
+    elif args.action == 'install':
+        if not state.install(targets):
+            print("Cannot install the bootloaders from the cache.")
+            return 1
+    else:
+        state.record(targets)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+#! /usr/bin/env python3
+
+# Headless entry point: drive USB Creator without a display.
+# Uses the same UDisks2 layer, backend and verification as the GUI but never
+# imports Gtk, so it can run on servers and from scripts.
+# Progress records of the backend go to USB_CREATOR_PROGRESS_FD when the
+# caller sets it (see progress.py).
+#
+# Command line usage:
+# cli.py devices [--json]
+# cli.py write --device /dev/sdb [--format] [--repair] [--verify] [--label LABEL] "/path/to/your.iso" [...]
+# cli.py verify --device /dev/sdb [--cache FILE] "/path/to/your.iso" [...]
+# cli.py unmount --device /dev/sdb [--power-off]
+
+import sys
+import json
+import argparse
+from os.path import exists, join, basename
+
+COMMANDS = ('devices', 'write', 'verify', 'unmount')
+BACKEND = 'usb-creator'
+# Exit codes of the backend
+EXIT_DEVICE = 3
+EXIT_ISO = 4
+EXIT_MOUNT = 6
+EXIT_MISMATCH = 7
+
+
+# Return the UDisks2 devices tree of the USB drives
+def get_udisks2():
+    from udisks2 import Udisks2
+    udisks2 = Udisks2()
+    udisks2.fill_devices(flash_only=True)
+    return udisks2
+
+
+# Return the mount point of the first partition of a drive (mounted when needed)
+def mount_drive(udisks2, drive_path):
+    device_paths = udisks2.get_drive_device_paths(drive_path)
+    if not device_paths:
+        return ''
+    device = device_paths[0]
+    mount = udisks2.devices[drive_path][device]['mount_point']
+    if not exists(mount):
+        mount = udisks2.mount_device(device)
+    return mount
+
+
+def list_devices(args):
+    udisks2 = get_udisks2()
+    drives = []
+    for drive_path in udisks2.get_drives():
+        drive = udisks2.devices[drive_path]
+        partitions = []
+        for device in udisks2.get_drive_device_paths(drive_path):
+            partitions.append({'device': device,
+                               'fs_type': drive[device]['fs_type'],
+                               'mount_point': drive[device]['mount_point'],
+                               'total_kb': int(drive[device]['total_size']),
+                               'free_kb': int(drive[device]['free_size'])})
+        drives.append({'drive': drive_path,
+                       'total_kb': int(drive['total_size']),
+                       'partitions': partitions})
+    if args.json:
+        print((json.dumps(drives, indent=1)))
+        return 0
+    for drive in drives:
+        print(("{}: {} MB".format(drive['drive'], int(drive['total_kb'] / 1024))))
+        for partition in drive['partitions']:
+            print(("  {} {} {} ({} MB free)".format(partition['device'], partition['fs_type'],
+                                                   partition['mount_point'] or '-',
+                                                   int(partition['free_kb'] / 1024))))
+    return 0
+
+
+# Build the arguments of the backend like the GUI does
+def backend_arguments(args):
+    arguments = [BACKEND, '-d', args.device]
+    if args.format:
+        arguments += ['-f', '-b']
+    if args.repair:
+        arguments += ['-r', '-b', '-g']
+    if args.label:
+        arguments += ['-l', args.label]
+    if args.isos:
+        # The backend splits the ISOs on white space
+        arguments += ['-i', ' '.join(args.isos)]
+    if args.verify or args.repair:
+        arguments.append('-s')
+    return arguments
+
+
+def write(args):
+    import subprocess
+    for iso in args.isos:
+        if not exists(iso):
+            print(("{} does not exist.".format(iso)))
+            return EXIT_ISO
+    arguments = backend_arguments(args)
+    print(("Execute command: {}".format(' '.join(arguments))))
+    sys.stdout.flush()
+    # The backend inherits USB_CREATOR_PROGRESS_FD from the environment
+    return subprocess.call(arguments, close_fds=False)
+
+
+def verify(args):
+    from verifier import Verifier, print_result
+    udisks2 = get_udisks2()
+    if args.device not in udisks2.get_drives():
+        print(("{} is not a USB drive.".format(args.device)))
+        return EXIT_DEVICE
+    try:
+        mount = mount_drive(udisks2, args.device)
+    except Exception as e:
+        print(("Cannot mount {}: {}".format(args.device, e)))
+        return EXIT_MOUNT
+    if not exists(mount):
+        return EXIT_MOUNT
+    verifier = Verifier(cache_path=args.cache, result_callback=print_result)
+    results = verifier.verify([(iso, join(mount, basename(iso))) for iso in args.isos])
+    if [r for r in results if not r['match']]:
+        return EXIT_MISMATCH
+    return 0
+
+
+def unmount(args):
+    udisks2 = get_udisks2()
+    if args.device not in udisks2.get_drives():
+        print(("{} is not a USB drive.".format(args.device)))
+        return EXIT_DEVICE
+    udisks2.unmount_drive(args.device)
+    if args.power_off:
+        udisks2.poweroff_drive(args.device)
+    print(("You can now safely remove {}.".format(args.device)))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='USB Creator without a graphical interface.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    cmd = commands.add_parser('devices', help='List the USB drives')
+    cmd.add_argument('--json', action='store_true', help='Print the drives as JSON')
+    cmd.set_defaults(func=list_devices)
+
+    cmd = commands.add_parser('write', help='Add ISOs to a USB drive')
+    cmd.add_argument('--device', required=True, help='Device path of the USB')
+    cmd.add_argument('--format', action='store_true', help='Format the device (all data will be lost)')
+    cmd.add_argument('--repair', action='store_true', help='Repair an unbootable USB')
+    cmd.add_argument('--verify', action='store_true', help='Check the hashes of the copied ISOs')
+    cmd.add_argument('--label', help='Label of the USB')
+    cmd.add_argument('isos', nargs='*')
+    cmd.set_defaults(func=write)
+
+    cmd = commands.add_parser('verify', help='Check the ISOs on a USB drive against their sources')
+    cmd.add_argument('--device', required=True, help='Device path of the USB')
+    cmd.add_argument('--cache', help='Digest cache file of the source ISOs')
+    cmd.add_argument('isos', nargs='+')
+    cmd.set_defaults(func=verify)
+
+    cmd = commands.add_parser('unmount', help='Unmount a USB drive')
+    cmd.add_argument('--device', required=True, help='Device path of the USB')
+    cmd.add_argument('--power-off', action='store_true', help='Power off the drive')
+    cmd.set_defaults(func=unmount)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,54 @@
+#! /usr/bin/env python3
+
+# Values the GUI needs at start up, known when the package is built.
+# Reading them from here avoids running the backend script through grep
+# or apt-cache before the window can be shown.
+
+import re
+import gzip
+from os.path import join, abspath, dirname, exists
+from utils import get_config_dict, getPackageVersion
+
+PACKAGE = 'usb-creator'
+# Settings shared with the backend, which sources usb-creator.conf
+CONFIG_FILE = join(dirname(abspath(__file__)), 'usb-creator.conf')
+_config = get_config_dict(CONFIG_FILE)
+LOG_FILE = _config['LOG']
+LOG_MAX_SIZE_KB = int(_config['MAX_SIZE_KB'])
+# Milliseconds without typing before the ISO path is evaluated
+ISO_ENTRY_DELAY = 200
+
+# The first line of the Debian changelog holds the version
+CHANGELOG_FILES = ['/usr/share/doc/{}/changelog.gz'.format(PACKAGE),
+                   '/usr/share/doc/{}/changelog.Debian.gz'.format(PACKAGE),
+                   # Running from the source tree
+                   join(dirname(abspath(__file__)), '../../../debian/changelog')]
+
+_version = None
+
+
+# Return the version of the package, read when first needed
+def get_version():
+    global _version
+    if _version is None:
+        _version = read_changelog_version()
+        if _version is None:
+            # Not installed from a package with a changelog: ask apt
+            _version = getPackageVersion(PACKAGE)
+    return _version
+
+
+def read_changelog_version():
+    for path in CHANGELOG_FILES:
+        if not exists(path):
+            continue
+        try:
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt') as f:
+                line = f.readline()
+        except (OSError, EOFError):
+            continue
+        matchObj = re.match(r'^\S+ \(([^)]+)\)', line)
+        if matchObj:
+            return matchObj.group(1)
+    return None
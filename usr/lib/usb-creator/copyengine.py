@@ -0,0 +1,386 @@
+#! /usr/bin/env python3
+
+# Stream ISOs to the mounted USB partition in large aligned chunks.
+# Progress is reported as structured events (dictionaries) to a callback.
+# With verify=True the source is hashed while it is copied and only the
+# target is read back (bypassing the page cache) to check what is on the device.
+# Dirty data is limited per target: every written window is flushed with
+# sync_file_range() so progress reports how many bytes are on the device.
+#
+# Command line usage (used by the usb-creator backend):
+# copyengine.py [--buffer-size MB] [--direct] [--verify [--digest-cache FILE]] [--json]
+#               "/path/to/your.iso" "/mount/point/"
+
+import os
+import sys
+import mmap
+import json
+import time
+import fcntl
+import ctypes
+import hashlib
+import argparse
+from os.path import join, isdir, basename, dirname, exists
+from progress import ProgressWriter
+from pipeline import BufferPipeline, DEFAULT_BUFFER_COUNT, format_stats
+
+# Default copy buffer: 8 MB
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024
+# O_DIRECT needs buffers, offsets and lengths aligned to the logical block size
+ALIGNMENT = 4096
+# Exit code of the command line when the hashes do not match
+EXIT_MISMATCH = 7
+# Default amount of written data that is flushed at once: 32 MB
+DEFAULT_WRITEBACK_WINDOW = 32 * 1024 * 1024
+
+# sync_file_range() flags (linux/fs.h)
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+
+# sync_file_range() is not in the os module: call it from libc
+def _get_sync_file_range():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        func = libc.sync_file_range
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+    func.restype = ctypes.c_int
+    return func
+
+_sync_file_range = _get_sync_file_range()
+
+
+def sync_file_range(fd, offset, nbytes, flags):
+    if _sync_file_range(fd, offset, nbytes, flags) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+# Keep the dirty data of a file being written below two windows.
+# When a window is complete its write-back is started; the window before
+# it is waited for and dropped from the page cache. This avoids a pile-up
+# of dirty pages followed by a long final sync that freezes the desktop.
+class WritebackWindow():
+    def __init__(self, fd, window=DEFAULT_WRITEBACK_WINDOW, drop_cache=True):
+        self.fd = fd
+        self.window = window
+        self.drop_cache = drop_cache and hasattr(os, 'posix_fadvise')
+        # Bytes known to be written to the device
+        self.durable = 0
+        # End of the written data handed to write-back
+        self.submitted = 0
+
+    # Tell how many bytes have been written; returns the durable bytes
+    def written(self, offset):
+        if self.window <= 0 or offset - self.submitted < self.window:
+            return self.durable
+        if _sync_file_range is None:
+            os.fdatasync(self.fd)
+            self._done(offset)
+            return self.durable
+        # Wait for the previous window and start the write-back of the new one
+        if self.submitted > self.durable:
+            sync_file_range(self.fd, self.durable, self.submitted - self.durable,
+                            SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+            self._done(self.submitted)
+        sync_file_range(self.fd, self.submitted, offset - self.submitted, SYNC_FILE_RANGE_WRITE)
+        self.submitted = offset
+        return self.durable
+
+    # Flush everything (including metadata); returns the durable bytes
+    def finish(self, offset):
+        os.fsync(self.fd)
+        self._done(offset)
+        return self.durable
+
+    def _done(self, offset):
+        if self.drop_cache and offset > self.durable:
+            os.posix_fadvise(self.fd, self.durable, offset - self.durable, os.POSIX_FADV_DONTNEED)
+        self.durable = offset
+        self.submitted = max(self.submitted, offset)
+
+
+# Read until the buffer is full or end of file is reached
+def fill_buffer(fd, buf):
+    n = 0
+    size = len(buf)
+    view = memoryview(buf)
+    try:
+        while n < size:
+            r = os.readv(fd, [view[n:]])
+            n += r
+            # An unaligned short read only happens at the end of the file
+            # and O_DIRECT cannot read again from an unaligned offset
+            if r == 0 or r % ALIGNMENT:
+                break
+    finally:
+        view.release()
+    return n
+
+
+# Return the sha256 hex digest of a file
+# With direct=True the page cache is bypassed (O_DIRECT) or dropped first
+# so that the digest reflects what is physically stored on the device.
+def sha256_file(path, direct=False, buffer_size=DEFAULT_BUFFER_SIZE, progress_callback=None):
+    sha = hashlib.sha256()
+    fd = -1
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+        except OSError:
+            fd = -1
+    if fd < 0:
+        fd = os.open(path, os.O_RDONLY)
+        if direct and hasattr(os, 'posix_fadvise'):
+            # Clean pages are dropped: flush first, then evict
+            try:
+                os.fdatasync(fd)
+            except OSError:
+                pass
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    buf = mmap.mmap(-1, max(ALIGNMENT, (buffer_size // ALIGNMENT) * ALIGNMENT))
+    view = memoryview(buf)
+    try:
+        total = os.fstat(fd).st_size
+        done = 0
+        start = time.monotonic()
+        while done < total:
+            n = fill_buffer(fd, buf)
+            if n == 0:
+                break
+            sha.update(view[:n])
+            done += n
+            if progress_callback is not None:
+                elapsed = time.monotonic() - start
+                rate = done / elapsed if elapsed > 0 else 0
+                progress_callback({'event': 'progress',
+                                   'phase': 'verify',
+                                   'source': path,
+                                   'bytes_done': done,
+                                   'bytes_total': total,
+                                   'rate': int(rate),
+                                   'eta': (total - done) / rate if rate > 0 else None})
+    finally:
+        view.release()
+        buf.close()
+        os.close(fd)
+    return sha.hexdigest()
+
+
+class CopyEngine():
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, direct=False, fadvise=True,
+                 progress_callback=None, progress_interval=0.5, verify=False,
+                 writeback_window=DEFAULT_WRITEBACK_WINDOW, buffer_count=DEFAULT_BUFFER_COUNT):
+        # Round the buffer size up to a multiple of the alignment
+        self.buffer_size = max(ALIGNMENT, ((int(buffer_size) + ALIGNMENT - 1) // ALIGNMENT) * ALIGNMENT)
+        # Buffers in flight between the reader and the writer thread
+        self.buffer_count = buffer_count
+        self.direct = direct and hasattr(os, 'O_DIRECT')
+        self.fadvise = fadvise and hasattr(os, 'posix_fadvise')
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        self.verify = verify
+        self.writeback_window = writeback_window
+        # Set after each copy when verify is True
+        self.source_digest = None
+        self.target_digest = None
+        # (size, mtime_ns, inode) of the source when the copy started
+        self.source_key = None
+
+    # Copy source to target (file or directory)
+    # Returns the path of the copied file
+    def copy(self, source, target):
+        if isdir(target):
+            target = join(target, basename(source))
+        # Write to a hidden temporary file and rename when done
+        # so that a partial ISO never shows up on the device
+        tmp_target = join(dirname(target), '.{}.part'.format(basename(target)))
+        st = os.stat(source)
+        self.source_key = (st.st_size, st.st_mtime_ns, st.st_ino)
+        self.source_digest = None
+        self.target_digest = None
+        sha = hashlib.sha256() if self.verify else None
+
+        src_fd = os.open(source, os.O_RDONLY)
+        try:
+            dst_fd = self._open_target(tmp_target)
+            try:
+                self._advise(src_fd, 'POSIX_FADV_SEQUENTIAL')
+                self._copy_fd(src_fd, dst_fd, source, st.st_size, sha)
+            finally:
+                os.close(dst_fd)
+        except BaseException:
+            if exists(tmp_target):
+                os.remove(tmp_target)
+            raise
+        finally:
+            os.close(src_fd)
+
+        # Keep the modification time (like rsync -a)
+        os.utime(tmp_target, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp_target, target)
+
+        if sha is not None:
+            # Only the target is read again
+            self.source_digest = sha.hexdigest()
+            self.target_digest = sha256_file(target, direct=True,
+                                             buffer_size=self.buffer_size,
+                                             progress_callback=self.progress_callback)
+        return target
+
+    # True when the last copy was verified and the digests match
+    def verified(self):
+        return self.source_digest is not None and self.source_digest == self.target_digest
+
+    def _open_target(self, path):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        if self.direct:
+            try:
+                return os.open(path, flags | os.O_DIRECT, 0o644)
+            except OSError:
+                # File system does not support O_DIRECT
+                self.direct = False
+        return os.open(path, flags, 0o644)
+
+    def _advise(self, fd, advice):
+        if self.fadvise:
+            try:
+                os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+            except OSError:
+                pass
+
+    def _copy_fd(self, src_fd, dst_fd, source, total, sha=None):
+        # The source is read (and hashed) in a second thread while the target is written
+        pipeline = BufferPipeline(self.buffer_size, self.buffer_count)
+        done = 0
+        last_report = 0
+        start = time.monotonic()
+        writeback = WritebackWindow(dst_fd, self.writeback_window, self.fadvise)
+        self._emit('start', source, 0, total, start, 0)
+
+        def read(view):
+            n = fill_buffer(src_fd, view)
+            if sha is not None:
+                sha.update(view[:n])
+            return n, None
+
+        def write(view, n, tag):
+            nonlocal done, last_report
+            if self.direct and n % ALIGNMENT:
+                # Unaligned tail: finish without O_DIRECT
+                flags = fcntl.fcntl(dst_fd, fcntl.F_GETFL)
+                fcntl.fcntl(dst_fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+            written = 0
+            while written < n:
+                written += os.write(dst_fd, view[written:n])
+            done += n
+            durable = writeback.written(done)
+            now = time.monotonic()
+            if now - last_report >= self.progress_interval:
+                last_report = now
+                self._emit('progress', source, done, total, start, durable,
+                           pipeline.stats())
+
+        pipeline.run(read, write)
+        durable = writeback.finish(done)
+        self._emit('done', source, done, total, start, durable, pipeline.stats())
+
+    def _emit(self, event, source, done, total, start, durable, stats=None):
+        if self.progress_callback is None:
+            return
+        elapsed = time.monotonic() - start
+        rate = done / elapsed if elapsed > 0 else 0
+        eta = (total - done) / rate if rate > 0 else None
+        record = {'event': event,
+                  'phase': 'copy',
+                  'source': source,
+                  'bytes_done': done,
+                  'bytes_durable': durable,
+                  'bytes_total': total,
+                  'rate': int(rate),
+                  'eta': eta}
+        if stats:
+            record.update(stats)
+        self.progress_callback(record)
+
+
+# Human readable progress for the log file
+def print_progress(event):
+    if event['event'] == 'start':
+        print(("Copying ISO {} ({} kB)".format(event['source'], int(event['bytes_total'] / 1024))))
+    elif event['event'] == 'progress' and event['phase'] == 'verify':
+        return
+    elif event['event'] == 'progress':
+        # Data that is not yet on the device is still to be copied
+        left = int((event['bytes_total'] - event.get('bytes_durable', event['bytes_done'])) / 1024)
+        print(("kB left to copy: {} ({:.1f} MB/s)".format(left, event['rate'] / 1048576)))
+    elif event['event'] == 'done':
+        print(("Copy finished: {} ({:.1f} MB/s, {})".format(event['source'], event['rate'] / 1048576,
+                                                            format_stats(event))))
+    sys.stdout.flush()
+
+
+def print_json(event):
+    print((json.dumps(event)))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy ISOs to a mounted USB partition.')
+    parser.add_argument('--buffer-size', type=int, default=DEFAULT_BUFFER_SIZE // 1048576,
+                        help='Copy buffer size in MB')
+    parser.add_argument('--buffer-count', type=int, default=DEFAULT_BUFFER_COUNT,
+                        help='Number of buffers between the reader and the writer')
+    parser.add_argument('--direct', action='store_true',
+                        help='Bypass the page cache when writing (O_DIRECT)')
+    parser.add_argument('--no-fadvise', action='store_true',
+                        help='Do not pass posix_fadvise hints')
+    parser.add_argument('--writeback-window', type=int, default=DEFAULT_WRITEBACK_WINDOW // 1048576,
+                        help='Flush written data to the device every N MB (0: only at the end)')
+    parser.add_argument('--verify', action='store_true',
+                        help='Hash while copying and check the target by reading it back')
+    parser.add_argument('--digest-cache',
+                        help='Store the source digest in this digest cache file')
+    parser.add_argument('--json', action='store_true',
+                        help='Print progress events as JSON lines')
+    parser.add_argument('source')
+    parser.add_argument('target')
+    args = parser.parse_args()
+
+    # Progress goes to stdout (log file) and to the GUI's progress channel
+    channel = ProgressWriter.from_environment()
+    printer = print_json if args.json else print_progress
+
+    def report(event):
+        printer(event)
+        channel.emit(event)
+
+    engine = CopyEngine(buffer_size=args.buffer_size * 1048576,
+                        direct=args.direct,
+                        fadvise=not args.no_fadvise,
+                        progress_callback=report,
+                        verify=args.verify,
+                        writeback_window=args.writeback_window * 1048576,
+                        buffer_count=args.buffer_count)
+    try:
+        target = engine.copy(args.source, args.target)
+    except OSError as e:
+        print(("Copy of {} failed: {}".format(args.source, e)))
+        return 1
+    if args.verify:
+        if not engine.verified():
+            print(("sha256sum of {} does NOT match original. Original: {}, Target: {}".format(
+                   args.source, engine.source_digest, engine.target_digest)))
+            return EXIT_MISMATCH
+        print(("sha256sum of target {} matches original: {}".format(basename(target), engine.source_digest)))
+        if args.digest_cache:
+            from digestcache import DigestCache
+            DigestCache(args.digest_cache).put(args.source, engine.source_digest, engine.source_key)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
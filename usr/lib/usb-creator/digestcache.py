@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+
+# Persistent sha256 cache of ISO files.
+# The cache is an append-only JSON-lines file. Each line holds the digest
+# of a file together with its path, size, mtime_ns and inode. An entry is
+# only used when the file still has the same size, mtime and inode;
+# otherwise the digest is recomputed and a new line is appended.
+#
+# Command line usage (prints like sha256sum):
+# digestcache.py --cache ~/.usb-creator/digestcache.jsonl "/path/to/your.iso" [...]
+
+import os
+import sys
+import json
+import argparse
+from os.path import abspath, exists, dirname
+from copyengine import sha256_file
+
+# Rewrite the cache file when it has this many times more lines than entries
+COMPACT_RATIO = 2
+
+
+class DigestCache():
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.lines = 0
+        self.load()
+
+    def load(self):
+        self.entries.clear()
+        self.lines = 0
+        if not exists(self.cache_path):
+            return
+        with open(self.cache_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry['path']] = entry
+                    self.lines += 1
+                except (ValueError, KeyError, TypeError):
+                    # Skip partially written lines
+                    continue
+
+    # Return the cache key of a file: (size, mtime_ns, inode)
+    def get_key(self, path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    # Return the cached digest or None when unknown or stale
+    def get(self, path):
+        path = abspath(path)
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        try:
+            key = self.get_key(path)
+        except OSError:
+            return None
+        if key != (entry['size'], entry['mtime_ns'], entry['inode']):
+            return None
+        return entry['sha256']
+
+    # Store a digest that was computed elsewhere (e.g. while copying)
+    # The file must not have changed since the digest was computed.
+    def put(self, path, digest, key=None):
+        path = abspath(path)
+        if key is None:
+            key = self.get_key(path)
+        entry = {'path': path,
+                 'size': key[0],
+                 'mtime_ns': key[1],
+                 'inode': key[2],
+                 'sha256': digest}
+        self.entries[path] = entry
+        self._append(entry)
+
+    # Return the sha256 of path, computed only when not cached
+    def sha256(self, path):
+        digest = self.get(path)
+        if digest is None:
+            key = self.get_key(path)
+            digest = sha256_file(path)
+            # Do not cache when the file changed while hashing
+            if key == self.get_key(path):
+                self.put(path, digest, key)
+        return digest
+
+    def _append(self, entry):
+        if self.lines >= COMPACT_RATIO * max(len(self.entries), 16):
+            self.compact()
+            return
+        cache_dir = dirname(self.cache_path)
+        if cache_dir and not exists(cache_dir):
+            os.makedirs(cache_dir)
+        with open(self.cache_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.lines += 1
+
+    # Rewrite the cache with current entries of existing files only
+    def compact(self):
+        tmp_path = '{}.tmp'.format(self.cache_path)
+        with open(tmp_path, 'w') as f:
+            for path, entry in list(self.entries.items()):
+                if not exists(path):
+                    del self.entries[path]
+                    continue
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, self.cache_path)
+        self.lines = len(self.entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sha256sum with a persistent cache.')
+    parser.add_argument('--cache', required=True, help='Path to the cache file')
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    cache = DigestCache(args.cache)
+    ret = 0
+    for path in args.files:
+        try:
+            print(("{}  {}".format(cache.sha256(path), path)))
+        except OSError as e:
+            print(("{}: {}".format(path, e)), file=sys.stderr)
+            ret = 1
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+
+# Guess the distribution of ISOs from their names and build their Grub menu.
+# The distributions, their families and the Grub menu templates are kept in
+# usr/share/usb-creator/distros.json. All distribution keywords are compiled
+# into one regular expression: the longest keyword found in the ISO name wins,
+# on a tie the family listed first wins. When the name does not tell the
+# distribution, the layout of the ISO (/casper, /live, ...) is used.
+# With an index cache the kernel and initrd paths of the templates are
+# checked against the files on the ISO and replaced by the real ones.
+#
+# grub.cfg is written by grubcfg.py.
+#
+# Command line usage:
+# distros.py [--index-cache FILE] "/path/to/your.iso" /dir/with/isos [...]
+
+import os
+import re
+import sys
+import json
+import argparse
+from iso9660 import read_volume_info, IsoError
+from isoindex import IndexCache, resolve_menu_lines
+from os.path import join, basename, dirname, abspath, isdir
+
+DISTROS_FILE = abspath(join(dirname(__file__), '../../share/usb-creator/distros.json'))
+# Exit code of the command line when a distribution cannot be guessed
+EXIT_UNKNOWN = 11
+
+# 32-bit ISOs: i386, i686, ... in the name or 32 between separators in the path
+ARCH32_NAME = re.compile(r'[3456]86')
+ARCH32_PATH = re.compile(r'[-_.\s]32[-_.\sb]')
+
+
+# Return the volume information of an ISO or None when it cannot be read
+def get_volume_info(iso):
+    try:
+        return read_volume_info(iso)
+    except (OSError, IsoError):
+        return None
+
+
+# Return the volume id of an ISO
+def get_volume_id(iso):
+    info = get_volume_info(iso)
+    return info['volume_id'] if info else ''
+
+
+# Make a menu title from the ISO name
+def get_menu_title(iso_name):
+    title = re.sub(r'^[0-9]*[-_ .]*', '', iso_name, count=1)
+    title = re.sub(r'x*86_64', '64', title, count=1)
+    title = re.sub(r'[-_]', ' ', title)
+    title = title.replace('bit', ' ', 1)
+    title = title.replace('64', '64-bit', 1)
+    title = re.sub(r'i*[3456]86', '32', title, count=1)
+    title = title.replace('32', '32-bit', 1)
+    title = title[:1].upper() + title[1:]
+    # Remove extension
+    if '.' in title:
+        title = title[:title.rfind('.')]
+    return title.strip()
+
+
+class DistroDatabase():
+    def __init__(self, path=DISTROS_FILE, index_cache=None):
+        self.index_cache = index_cache
+        with open(path, 'r') as f:
+            data = json.load(f)
+        self.families = data['families']
+        self.templates = data['templates']
+        # Keyword -> (family index, family name), first family wins
+        self.keywords = {}
+        order = []
+        for index, family in enumerate(self.families):
+            for keyword in family['distros']:
+                if keyword not in self.keywords:
+                    self.keywords[keyword] = (index, family['family'])
+                    order.append(keyword)
+        # At every position the first alternative that matches is taken:
+        # list longer keywords first. The look-ahead finds overlapping matches.
+        order.sort(key=lambda k: (-len(k), self.keywords[k][0]))
+        self.regex = re.compile('(?=({}))'.format('|'.join(re.escape(k) for k in order)))
+
+    # Return (family, distro) of an ISO name or ('', '')
+    def match(self, iso_name):
+        best = ''
+        for m in self.regex.finditer(iso_name.lower()):
+            keyword = m.group(1)
+            if len(keyword) > len(best) or \
+               (len(keyword) == len(best) and self.keywords[keyword][0] < self.keywords[best][0]):
+                best = keyword
+        if not best:
+            return ('', '')
+        return (self.keywords[best][1], best)
+
+    # Return the family of an ISO from the directories on the ISO or ''
+    def match_layout(self, iso):
+        info = get_volume_info(iso)
+        if info is None:
+            return ''
+        for family in self.families:
+            if family.get('layout') in info['layout']:
+                return family['family']
+        return ''
+
+    # Return the files on the ISO or None without index cache
+    def get_files(self, iso):
+        if self.index_cache is None:
+            return None
+        try:
+            return self.index_cache.get(iso)
+        except (OSError, IsoError):
+            return None
+
+    # Return a dictionary with family, distro, architecture and menu lines of an ISO
+    def detect(self, iso):
+        iso_name = basename(iso)
+        lower_name = iso_name.lower()
+        family_name, distro = self.match(iso_name)
+        if not family_name:
+            family_name = self.match_layout(iso)
+        architecture = '32' if ARCH32_NAME.search(lower_name) or ARCH32_PATH.search(iso) else '64'
+        result = {'iso': iso,
+                  'name': iso_name,
+                  'family': family_name,
+                  'distro': distro,
+                  'architecture': architecture,
+                  'title': get_menu_title(iso_name),
+                  'linux': '',
+                  'initrd': '',
+                  'download': ''}
+        if not family_name:
+            return result
+
+        # Family defaults, overruled by the first matching variant
+        family = [f for f in self.families if f['family'] == family_name][0]
+        settings = dict((k, v) for k, v in family.items() if k not in ('family', 'distros', 'variants'))
+        for variant in family.get('variants', []):
+            if 'distros' in variant and distro not in variant['distros']:
+                continue
+            if 'name' in variant and variant['name'] not in lower_name:
+                continue
+            if 'not_name' in variant and variant['not_name'] in lower_name:
+                continue
+            settings.update((k, v) for k, v in variant.items() if k not in ('distros', 'name', 'not_name'))
+            break
+
+        linux = self.templates.get(settings.get('linux'), '')
+        initrd = self.templates.get(settings.get('initrd'), '')
+        if not settings.get('efi', True):
+            linux = linux.replace('vmlinuz.efi', 'vmlinuz')
+        if settings.get('volume_id'):
+            keyword = settings['volume_id']
+            linux = linux.replace(keyword, '{}={}'.format(keyword, get_volume_id(iso)), 1)
+        if architecture == '32' and 'arch32' in settings:
+            if settings['arch32']:
+                linux = linux.replace('x86_64', settings['arch32'], 1)
+                initrd = initrd.replace('x86_64', settings['arch32'], 1)
+            linux = linux.replace('vmlinuz.efi', 'vmlinuz', 1)
+        if not linux:
+            result['family'] = ''
+            return result
+        files = self.get_files(iso)
+        if files:
+            linux, initrd = resolve_menu_lines(files, linux, initrd)
+        result['linux'] = linux
+        result['initrd'] = initrd
+        result['download'] = settings.get('download', '')
+        return result
+
+    # Detect all ISOs in the given files and directories in one call
+    def detect_all(self, paths):
+        return [self.detect(iso) for iso in find_isos(paths)]
+
+
+# Expand directories to the ISOs they contain
+def find_isos(paths):
+    isos = []
+    for path in paths:
+        if isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                isos += [join(root, f) for f in sorted(files) if f.endswith('.iso')]
+        else:
+            isos.append(path)
+    return isos
+
+
+# Return the Grub menu entry of a detected ISO
+def menu_entry(result):
+    lines = ["menuentry '{}' {{".format(result['title']),
+             "  set isofile='/{}'".format(result['name']),
+             "  insmod loopback",
+             "  loopback loop $isofile",
+             "  {}".format(result['linux']),
+             "  {}".format(result['initrd']),
+             "}"]
+    return '\n'.join(lines) + '\n\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Guess the distribution of ISOs and print their Grub menu.')
+    parser.add_argument('--index-cache', help='Cache of the file indexes of the ISOs')
+    parser.add_argument('--database', default=DISTROS_FILE, help='Distribution database')
+    parser.add_argument('paths', nargs='+', help='ISOs or directories with ISOs')
+    args = parser.parse_args()
+
+    index_cache = IndexCache(args.index_cache) if args.index_cache else None
+    database = DistroDatabase(args.database, index_cache)
+    results = database.detect_all(args.paths)
+    if index_cache is not None:
+        index_cache.save()
+    ret = 0
+    menu = ''
+    for result in results:
+        print(("Family/distro of {} = {}/{}".format(result['name'], result['family'], result['distro'])))
+        if not result['family']:
+            print(("Could not guess distribution from ISO name: {}.".format(result['name'])))
+            ret = EXIT_UNKNOWN
+            continue
+        menu += menu_entry(result)
+    sys.stdout.write(menu)
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
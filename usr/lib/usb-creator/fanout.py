@@ -0,0 +1,200 @@
+#! /usr/bin/env python3
+
+# Read an ISO once and write it to several targets.
+# A reader thread fills a bounded ring buffer of chunks. Every target has
+# its own writer thread that consumes the chunks at its own speed. A chunk
+# is reused when all writers have written it, so the reader only stalls
+# when the slowest writer is a full ring behind. A failing writer is
+# dropped without stopping the others. Every writer limits its dirty data
+# with a write-back window (see copyengine.py) so a slow stick does not fill
+# the page cache and its progress shows what is really on the device.
+
+import os
+import time
+import hashlib
+import threading
+from os.path import join, isdir, basename, dirname, exists
+from copyengine import fill_buffer, WritebackWindow, DEFAULT_WRITEBACK_WINDOW
+
+# Default ring buffer: 8 chunks of 8 MB
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_CHUNKS = 8
+
+
+class FanoutCopier():
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, chunks=DEFAULT_CHUNKS,
+                 progress_callback=None, progress_interval=0.5, hash_source=False,
+                 writeback_window=DEFAULT_WRITEBACK_WINDOW):
+        self.chunk_size = chunk_size
+        self.chunks = max(2, chunks)
+        # Called with (target, event dictionary)
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        self.hash_source = hash_source
+        self.writeback_window = writeback_window
+        self.source_digest = None
+        # (size, mtime_ns, inode) of the source when the copy started
+        self.source_key = None
+        self.stats = {}
+
+    # Size of the ring buffer in bytes
+    def buffer_size(self):
+        return self.chunk_size * self.chunks
+
+    # Copy source to all targets (files or directories)
+    # Returns a dictionary with the exception per failed target (None when copied)
+    def copy(self, source, targets):
+        st = os.stat(source)
+        self.source_key = (st.st_size, st.st_mtime_ns, st.st_ino)
+        total = st.st_size
+        paths = []
+        for target in targets:
+            if isdir(target):
+                target = join(target, basename(source))
+            paths.append(target)
+
+        self.ring = [bytearray(self.chunk_size) for i in range(self.chunks)]
+        self.lengths = [0] * self.chunks
+        self.produced = 0
+        self.eof = False
+        self.read_error = None
+        self.consumed = dict((path, 0) for path in paths)
+        self.active = set(paths)
+        self.errors = dict((path, None) for path in paths)
+        self.cond = threading.Condition()
+        self.source_digest = None
+        self.stats = {'buffer_size': self.buffer_size(),
+                      'chunk_size': self.chunk_size,
+                      'high_water_mark': 0,
+                      'reader_stall_time': 0.0,
+                      'writer_wait_time': dict((path, 0.0) for path in paths)}
+
+        writers = []
+        for path in paths:
+            t = threading.Thread(target=self._write, args=(source, path, st))
+            t.daemon = True
+            t.start()
+            writers.append(t)
+        self._read(source, total)
+        for t in writers:
+            t.join()
+        if self.read_error is not None:
+            raise self.read_error
+        return self.errors
+
+    def _read(self, source, total):
+        sha = hashlib.sha256() if self.hash_source else None
+        # The digest is only valid when the whole source was read
+        complete = False
+        fd = os.open(source, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                with self.cond:
+                    # Wait until the slowest active writer freed a chunk
+                    start = time.monotonic()
+                    while self.active and self.produced - min(self.consumed[p] for p in self.active) >= self.chunks:
+                        self.cond.wait()
+                    self.stats['reader_stall_time'] += time.monotonic() - start
+                    if not self.active:
+                        break
+                    slot = self.produced % self.chunks
+                n = fill_buffer(fd, self.ring[slot])
+                if sha is not None and n:
+                    sha.update(memoryview(self.ring[slot])[:n])
+                with self.cond:
+                    if n == 0:
+                        self.eof = True
+                    else:
+                        self.lengths[slot] = n
+                        self.produced += 1
+                        if self.active:
+                            in_use = self.produced - min(self.consumed[p] for p in self.active)
+                            self.stats['high_water_mark'] = max(self.stats['high_water_mark'], in_use * self.chunk_size)
+                    self.cond.notify_all()
+                if n == 0:
+                    complete = True
+                    break
+        except OSError as e:
+            with self.cond:
+                self.read_error = e
+                self.eof = True
+                self.cond.notify_all()
+        finally:
+            os.close(fd)
+        if sha is not None and complete and self.read_error is None:
+            self.source_digest = sha.hexdigest()
+
+    def _write(self, source, target, st):
+        tmp_target = join(dirname(target), '.{}.part'.format(basename(target)))
+        total = st.st_size
+        done = 0
+        start = time.monotonic()
+        last_report = 0
+        self._emit(target, 'start', source, done, total, start, 0)
+        try:
+            fd = os.open(tmp_target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                writeback = WritebackWindow(fd, self.writeback_window)
+                while True:
+                    with self.cond:
+                        wait_start = time.monotonic()
+                        while self.consumed[target] == self.produced and not self.eof:
+                            self.cond.wait()
+                        self.stats['writer_wait_time'][target] += time.monotonic() - wait_start
+                        if self.consumed[target] == self.produced:
+                            break
+                        slot = self.consumed[target] % self.chunks
+                        n = self.lengths[slot]
+                    view = memoryview(self.ring[slot])
+                    try:
+                        written = 0
+                        while written < n:
+                            written += os.write(fd, view[written:n])
+                    finally:
+                        view.release()
+                    done += n
+                    with self.cond:
+                        self.consumed[target] += 1
+                        self.cond.notify_all()
+                    durable = writeback.written(done)
+                    now = time.monotonic()
+                    if now - last_report >= self.progress_interval:
+                        last_report = now
+                        self._emit(target, 'progress', source, done, total, start, durable)
+                if self.read_error is not None:
+                    raise self.read_error
+                durable = writeback.finish(done)
+            finally:
+                os.close(fd)
+            os.utime(tmp_target, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(tmp_target, target)
+            self._emit(target, 'done', source, done, total, start, durable)
+        except OSError as e:
+            self.errors[target] = e
+            if exists(tmp_target):
+                try:
+                    os.remove(tmp_target)
+                except OSError:
+                    pass
+        finally:
+            # Never let the reader wait for this writer again
+            with self.cond:
+                self.active.discard(target)
+                self.cond.notify_all()
+
+    def _emit(self, target, event, source, done, total, start, durable):
+        if self.progress_callback is None:
+            return
+        elapsed = time.monotonic() - start
+        rate = done / elapsed if elapsed > 0 else 0
+        eta = (total - done) / rate if rate > 0 else None
+        self.progress_callback(target, {'event': event,
+                                        'phase': 'copy',
+                                        'source': source,
+                                        'target': target,
+                                        'bytes_done': done,
+                                        'bytes_durable': durable,
+                                        'bytes_total': total,
+                                        'rate': int(rate),
+                                        'eta': eta})
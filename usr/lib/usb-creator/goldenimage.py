@@ -0,0 +1,205 @@
+#! /usr/bin/env python3
+
+# Golden image mode: prepare a stick once, write it to many identical sticks.
+# The backend builds the image with its usual steps (partition, format,
+# bootloaders, ISOs, grub.cfg) on a loop device backed by a sparse file
+# (usb-creator -o IMAGE). This module then hashes the data extents of the
+# image once and writes them to sticks with large sequential writes. The
+# unallocated regions are free space of the file system and are skipped, so
+# a stick only gets as much I/O as there is data. With --zero-holes they
+# are written as zeros as well (a write of the whole stick, unless it
+# zeroes itself, see rawwriter.py). Every stick is verified against the
+# precomputed hash list.
+#
+# Command line usage (used by the usb-creator backend):
+# goldenimage.py index --image IMAGE [--zero-holes]
+# goldenimage.py write --image IMAGE [--no-verify] [--zero-holes] (--all | /dev/sdb /dev/sdc ...)
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+import threading
+from os.path import exists, basename
+from rawwriter import RawWriter, hash_extents, data_extents, get_size, print_progress, \
+    EXIT_MISMATCH, EXIT_WRITE
+from progress import ProgressWriter
+
+EXIT_DEVICE = 3
+EXIT_SPACE = 10
+
+
+# Path of the hash list of an image
+def hash_list_path(image):
+    return image + '.extents.json'
+
+
+# Return the number of bytes in the data extents of an image
+def data_size(image):
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        return sum(length for offset, length in data_extents(fd, get_size(fd)))
+    finally:
+        os.close(fd)
+
+
+# Hash the image (only its data extents when sparse) and save the list next to it
+def index_image(image, sparse=True):
+    st = os.stat(image)
+    index = {'size': st.st_size,
+             'mtime_ns': st.st_mtime_ns,
+             'sparse': sparse,
+             'data': data_size(image),
+             'extents': hash_extents(image, sparse=sparse)}
+    tmp_path = hash_list_path(image) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, hash_list_path(image))
+    return index
+
+
+# Return the hash list of an image, computed again when the image or the mode changed
+def load_index(image, sparse=True):
+    st = os.stat(image)
+    path = hash_list_path(image)
+    if exists(path):
+        try:
+            with open(path, 'r') as f:
+                index = json.load(f)
+            if index['size'] == st.st_size and index['mtime_ns'] == st.st_mtime_ns and \
+               index.get('sparse') == sparse:
+                return index
+        except (ValueError, KeyError):
+            pass
+    return index_image(image, sparse)
+
+
+# Unmount all mounted partitions of a device
+def unmount_device(device):
+    with open('/proc/mounts', 'r') as f:
+        partitions = [line.split()[0] for line in f if line.startswith(device)]
+    for partition in partitions:
+        subprocess.call(['udisksctl', 'unmount', '-b', partition], stdout=subprocess.DEVNULL)
+
+
+class GoldenImageWriter():
+    def __init__(self, image, verify=True, progress_callback=None, zero_holes=False):
+        self.image = image
+        self.verify = verify
+        # Only write the data extents unless the holes must be zeroed
+        self.sparse = not zero_holes
+        # Called with (device, event dictionary)
+        self.progress_callback = progress_callback
+        self.lock = threading.Lock()
+        self.index = load_index(image, self.sparse)
+
+    # Write the image to all devices at the same time
+    # Returns a dictionary with the exit code per device
+    def write(self, devices):
+        results = dict((device, 0) for device in devices)
+        threads = []
+        for device in devices:
+            t = threading.Thread(target=self._write_device, args=(device, results))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return results
+
+    def _write_device(self, device, results):
+        writer = RawWriter(skip_zeros=not self.sparse, progress_callback=lambda event: self.emit(device, event))
+        try:
+            unmount_device(device)
+            writer.write(self.image, device, sparse=self.sparse)
+        except OSError as e:
+            self.emit(device, {'event': 'error', 'phase': 'write', 'message': str(e)})
+            results[device] = EXIT_SPACE if e.errno == 28 else EXIT_WRITE
+            return
+        if self.verify:
+            self.emit(device, {'event': 'phase', 'phase': 'verify'})
+            if writer.verify(device, self.index['extents']):
+                self.emit(device, {'event': 'mismatch', 'phase': 'verify', 'source': self.image})
+                results[device] = EXIT_MISMATCH
+                return
+        # Let the kernel read the new partition table
+        subprocess.call(['blockdev', '--rereadpt', device], stderr=subprocess.DEVNULL)
+        self.emit(device, {'event': 'phase', 'phase': 'done'})
+
+    def emit(self, device, event):
+        if self.progress_callback is not None:
+            with self.lock:
+                self.progress_callback(device, event)
+
+
+def print_device_progress(device, event):
+    name = basename(device)
+    if event['event'] in ('start', 'progress', 'done'):
+        sys.stdout.write("[{}] ".format(name))
+        print_progress(event)
+    elif event['event'] == 'phase':
+        print(("[{}] Phase: {}".format(name, event['phase'])))
+    elif event['event'] == 'error':
+        print(("[{}] Error in {}: {}".format(name, event['phase'], event['message'])))
+    elif event['event'] == 'mismatch':
+        print(("[{}] Device does NOT match {}".format(name, event['source'])))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a golden image to USB devices.')
+    parser.add_argument('action', choices=['index', 'write'])
+    parser.add_argument('--image', required=True, help='Image built with usb-creator -o')
+    parser.add_argument('--no-verify', action='store_true', help='Do not read the devices back')
+    parser.add_argument('--all', action='store_true', help='Use all removable USB devices')
+    parser.add_argument('--zero-holes', action='store_true',
+                        help='Also write the free space of the image as zeros (writes the whole stick)')
+    parser.add_argument('devices', nargs='*')
+    args = parser.parse_args()
+
+    if args.action == 'index':
+        index = index_image(args.image, not args.zero_holes)
+        print(("Image {}: {} MB of data, {} hashed parts".format(
+               basename(args.image), int(index['data'] / 1048576),
+               len(index['extents']))))
+        return 0
+
+    # Only USB drives as UDisks2 sees them (like the batch writer): many sticks
+    # and USB disks report 0 in /sys/block/*/removable
+    from batchwriter import get_usb_drives
+    usb_drives = get_usb_drives()
+    devices = usb_drives if args.all else []
+    for device in args.devices:
+        if device in devices:
+            continue
+        if not exists(device):
+            print(("{} does not exist.".format(device)))
+        elif device not in usb_drives:
+            print(("{} is not a removable USB drive.".format(device)))
+        else:
+            devices.append(device)
+    if not devices:
+        print("No devices found.")
+        return EXIT_DEVICE
+
+    print(("Write {} to: {}".format(args.image, ', '.join(devices))))
+    channel = ProgressWriter.from_environment()
+
+    def report(device, event):
+        print_device_progress(device, event)
+        record = dict(event)
+        record['device'] = device
+        channel.emit(record)
+    writer = GoldenImageWriter(args.image, verify=not args.no_verify, progress_callback=report,
+                               zero_holes=args.zero_holes)
+    results = writer.write(devices)
+    ret = 0
+    for device in devices:
+        print(("[{}] Exit code: {}".format(basename(device), results[device])))
+        if results[device] and not ret:
+            ret = results[device]
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
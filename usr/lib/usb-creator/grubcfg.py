@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+
+# Keep grub.cfg on the USB in sync with the ISOs on it.
+# A manifest next to grub.cfg (boot/grub/usb-creator.json) maps every ISO
+# (name, size, mtime) to its rendered menu entry. Only ISOs that are new or
+# changed are detected and rendered again; removed ISOs are dropped. The
+# manifest and grub.cfg are written to a temporary file that is renamed
+# over the old one, so a pulled stick never has a half written grub.cfg.
+#
+# Command line usage (used by the usb-creator backend):
+# grubcfg.py [--label LABEL] [--index-cache FILE] /mount/point
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import subprocess
+from os.path import join, basename, dirname, exists, relpath
+from distros import DistroDatabase, DISTROS_FILE, EXIT_UNKNOWN, find_isos, menu_entry
+from isoindex import IndexCache
+
+MANIFEST_NAME = 'usb-creator.json'
+MANIFEST_VERSION = 1
+# An initrd could not be downloaded: its ISO has no menu entry
+EXIT_DOWNLOAD = 13
+
+GRUB_HEADER = '''# Seconds to wait until starting the default menu entry
+set timeout=10
+
+# Default menu entry (0 = first)
+set default=0
+
+# set debug=all
+set usblabel="{label}"
+search --no-floppy --set=root -l $usblabel
+probe -u $root --set=rootuuid
+set imgdevpath="/dev/disk/by-uuid/$rootuuid"
+
+if loadfont $prefix/fonts/unicode.pf2 ; then
+  set gfxmode=800x600
+  insmod efi_gop
+  insmod efi_uga
+  insmod video_bochs
+  insmod video_cirrus
+  insmod gfxterm
+  insmod png
+  terminal_output gfxterm
+fi
+
+background_image -m stretch /boot/grub/grubbg.png
+set menu_color_normal=white/black
+set menu_color_highlight=dark-gray/white
+
+'''
+
+
+# Write a file through a temporary file and a rename
+def write_atomic(path, text):
+    tmp_path = join(os.path.dirname(path), '.{}.tmp'.format(basename(path)))
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# Download a file through a temporary file; returns False when it failed
+def download(url, path):
+    tmp_path = join(dirname(path), '.{}.part'.format(basename(path)))
+    try:
+        ret = subprocess.call(['wget', url, '-O', tmp_path])
+    except OSError:
+        ret = -1
+    if ret != 0:
+        if exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+
+# Hash of the distribution database: entries are rendered again when it changes
+def database_digest(path=DISTROS_FILE):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class GrubConfig():
+    def __init__(self, mount, label='MULTIUSB', database=None, database_path=DISTROS_FILE):
+        self.mount = mount
+        self.label = label
+        self.grub_dir = join(mount, 'boot', 'grub')
+        self.cfg_path = join(self.grub_dir, 'grub.cfg')
+        self.manifest_path = join(self.grub_dir, MANIFEST_NAME)
+        self.database = database or DistroDatabase(database_path)
+        self.database_digest = database_digest(database_path)
+        # Filled by update()
+        self.added = []
+        self.removed = []
+        self.unknown = []
+        self.failed = []
+        self.results = []
+
+    def load_manifest(self):
+        if not exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except ValueError:
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION or \
+           manifest.get('database') != self.database_digest:
+            return {}
+        return manifest.get('isos', {})
+
+    # Bring grub.cfg up to date; returns the entries per ISO
+    def update(self):
+        old_entries = self.load_manifest()
+        entries = {}
+        self.added = []
+        self.unknown = []
+        self.failed = []
+        self.results = []
+        for iso in find_isos([self.mount]):
+            name = relpath(iso, self.mount)
+            st = os.stat(iso)
+            entry = old_entries.get(name)
+            if entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+                entries[name] = entry
+                continue
+            result = self.database.detect(iso)
+            self.results.append(result)
+            if not result['family']:
+                self.unknown.append(name)
+                continue
+            if result['download']:
+                # The installer ISO needs an initrd that can find the ISO
+                # Without it there is no menu entry, so the next run tries again
+                if not download(result['download'], iso + '.initrd.gz'):
+                    self.failed.append(name)
+                    continue
+            entries[name] = {'size': st.st_size,
+                             'mtime_ns': st.st_mtime_ns,
+                             'family': result['family'],
+                             'distro': result['distro'],
+                             'menu': menu_entry(result)}
+            self.added.append(name)
+        self.removed = sorted(set(old_entries) - set(entries))
+
+        cfg = GRUB_HEADER.format(label=self.label)
+        cfg += ''.join(entries[name]['menu'] for name in sorted(entries))
+        if not exists(self.cfg_path) or self.added or self.removed or self.read_cfg() != cfg:
+            write_atomic(self.cfg_path, cfg)
+        if self.added or self.removed or old_entries != entries:
+            write_atomic(self.manifest_path, json.dumps({'version': MANIFEST_VERSION,
+                                                         'database': self.database_digest,
+                                                         'isos': entries}, indent=1, sort_keys=True))
+        return entries
+
+    def read_cfg(self):
+        try:
+            with open(self.cfg_path, 'r') as f:
+                return f.read()
+        except OSError:
+            return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Update grub.cfg with the ISOs on the USB.')
+    parser.add_argument('--label', default='MULTIUSB', help='Label of the USB')
+    parser.add_argument('--index-cache', help='Cache of the file indexes of the ISOs')
+    parser.add_argument('mount', help='Mount point of the USB')
+    args = parser.parse_args()
+
+    index_cache = IndexCache(args.index_cache) if args.index_cache else None
+    config = GrubConfig(args.mount, args.label, DistroDatabase(index_cache=index_cache))
+    entries = config.update()
+    if index_cache is not None:
+        index_cache.save()
+
+    for result in config.results:
+        print(("Family/distro of {} = {}/{}".format(result['name'], result['family'], result['distro'])))
+    for name in config.unknown:
+        print(("Could not guess distribution from ISO name: {}.".format(basename(name))))
+    for name in config.failed:
+        print(("Could not download the initrd of {}: no menu entry added.".format(basename(name))))
+    print(("Grub menu: {} entries, {} added, {} removed".format(len(entries), len(config.added), len(config.removed))))
+    if config.unknown:
+        return EXIT_UNKNOWN
+    if config.failed:
+        return EXIT_DOWNLOAD
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+#! /usr/bin/env python3
+
+# Read the volume descriptors of an ISO9660 image without mounting it.
+# Only the descriptors from sector 16 on (and the El Torito boot catalog)
+# are read with pread(), so even multi-GB ISOs are probed in a few KB.
+# Results are cached per (path, mtime) for the lifetime of the process.
+#
+# Command line usage:
+# iso9660.py "/path/to/your.iso" [...]
+
+import os
+import sys
+import struct
+from os.path import basename
+
+SECTOR_SIZE = 2048
+# The volume descriptor set starts at sector 16
+FIRST_DESCRIPTOR = 16
+# Stop looking for the terminator after this many descriptors
+MAX_DESCRIPTORS = 32
+
+# Volume descriptor types
+VD_BOOT_RECORD = 0
+VD_PRIMARY = 1
+VD_SUPPLEMENTARY = 2
+VD_TERMINATOR = 255
+
+# El Torito platform ids
+PLATFORMS = {0: 'x86', 1: 'ppc', 2: 'mac', 0xef: 'efi'}
+
+# Directories that tell the layout of a live ISO
+LAYOUT_DIRS = ('casper', 'live', 'arch/boot')
+
+_cache = {}
+
+
+class IsoError(Exception):
+    pass
+
+
+def _text(data):
+    return data.decode('ascii', 'replace').strip(' \x00')
+
+
+# dec-datetime of a volume descriptor: YYYYMMDDHHMMSScc + offset
+def _date(data):
+    text = _text(data[:16])
+    if len(text) < 14 or not text.isdigit() or text[:4] == '0000':
+        return ''
+    return '{}-{}-{} {}:{}:{}'.format(text[0:4], text[4:6], text[6:8], text[8:10], text[10:12], text[12:14])
+
+
+# Return the directory records (name, extent, size, is_dir, raw record) of a directory extent
+def read_directory(fd, extent, size, joliet=False):
+    records = []
+    data = os.pread(fd, size, extent * SECTOR_SIZE)
+    pos = 0
+    while pos < len(data):
+        length = data[pos]
+        if length == 0:
+            # Records do not cross sectors: continue in the next sector
+            pos = (pos // SECTOR_SIZE + 1) * SECTOR_SIZE
+            continue
+        record = data[pos:pos + length]
+        pos += length
+        if len(record) < 34:
+            break
+        name_length = record[32]
+        raw_name = record[33:33 + name_length]
+        if raw_name in (b'\x00', b'\x01'):
+            # . and ..
+            continue
+        if joliet:
+            name = raw_name.decode('utf-16-be', 'replace')
+        else:
+            name = raw_name.decode('ascii', 'replace')
+        # Strip the version number
+        name = name.split(';')[0]
+        if not record[25] & 2:
+            name = name.rstrip('.')
+        records.append((name,
+                        struct.unpack_from('<I', record, 2)[0],
+                        struct.unpack_from('<I', record, 10)[0],
+                        bool(record[25] & 2),
+                        record))
+    return records
+
+
+# Return the (extent, size, is_dir) of a path in the primary tree or None
+def lookup(fd, root, path):
+    extent, size, is_dir = root
+    for part in [p for p in path.split('/') if p]:
+        if not is_dir:
+            return None
+        found = None
+        for name, child_extent, child_size, child_is_dir, record in read_directory(fd, extent, size):
+            if name.lower() == part.lower():
+                found = (child_extent, child_size, child_is_dir)
+                break
+        if found is None:
+            return None
+        extent, size, is_dir = found
+    return (extent, size, is_dir)
+
+
+def _read_el_torito(fd, catalog):
+    data = os.pread(fd, SECTOR_SIZE, catalog * SECTOR_SIZE)
+    # Validation entry: header id 1 and key 55 AA
+    if len(data) < 64 or data[0] != 1 or data[30:32] != b'\x55\xaa':
+        return None
+    platforms = [PLATFORMS.get(data[1], str(data[1]))]
+    bootable = data[32] == 0x88
+    # Section headers (0x90, 0x91 for the last) add platforms like EFI
+    pos = 64
+    while pos + 32 <= len(data):
+        if data[pos] in (0x90, 0x91):
+            platform = PLATFORMS.get(data[pos + 1], str(data[pos + 1]))
+            if platform not in platforms:
+                platforms.append(platform)
+            entries = struct.unpack_from('<H', data, pos + 2)[0]
+            if data[pos] == 0x91:
+                break
+            pos += 32 * (entries + 1)
+        else:
+            pos += 32
+    return {'catalog': catalog,
+            'bootable': bootable,
+            'platforms': platforms}
+
+
+# Return a dictionary with the volume information of an ISO
+def read_volume_info(path):
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns)
+    if key in _cache:
+        return _cache[key]
+
+    info = None
+    boot_catalog = None
+    joliet = None
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for sector in range(FIRST_DESCRIPTOR, FIRST_DESCRIPTOR + MAX_DESCRIPTORS):
+            data = os.pread(fd, SECTOR_SIZE, sector * SECTOR_SIZE)
+            if len(data) < SECTOR_SIZE or data[1:6] != b'CD001':
+                break
+            vd_type = data[0]
+            if vd_type == VD_TERMINATOR:
+                break
+            if vd_type == VD_PRIMARY and info is None:
+                root = data[156:190]
+                info = {'system_id': _text(data[8:40]),
+                        'volume_id': _text(data[40:72]),
+                        'volume_size': struct.unpack_from('<I', data, 80)[0],
+                        'block_size': struct.unpack_from('<H', data, 128)[0],
+                        'volume_set_id': _text(data[190:318]),
+                        'publisher': _text(data[318:446]),
+                        'preparer': _text(data[446:574]),
+                        'application': _text(data[574:702]),
+                        'creation_date': _date(data[813:830]),
+                        'modification_date': _date(data[830:847]),
+                        'root': (struct.unpack_from('<I', root, 2)[0],
+                                 struct.unpack_from('<I', root, 10)[0],
+                                 True)}
+            elif vd_type == VD_BOOT_RECORD and data[7:30] == b'EL TORITO SPECIFICATION':
+                boot_catalog = struct.unpack_from('<I', data, 71)[0]
+            elif vd_type == VD_SUPPLEMENTARY and data[88:90] == b'%/' and data[90:91] in (b'@', b'C', b'E'):
+                root = data[156:190]
+                joliet = (struct.unpack_from('<I', root, 2)[0],
+                          struct.unpack_from('<I', root, 10)[0],
+                          True)
+        if info is None:
+            raise IsoError("{} is not an ISO9660 image".format(path))
+        info['joliet'] = joliet
+        info['el_torito'] = _read_el_torito(fd, boot_catalog) if boot_catalog else None
+        info['layout'] = [d for d in LAYOUT_DIRS if lookup(fd, info['root'], d) is not None]
+    finally:
+        os.close(fd)
+
+    _cache[key] = info
+    return info
+
+
+def main():
+    for path in sys.argv[1:]:
+        try:
+            info = read_volume_info(path)
+        except (OSError, IsoError) as e:
+            print(("{}: {}".format(basename(path), e)))
+            continue
+        print(("{}:".format(basename(path))))
+        for key in ('volume_id', 'system_id', 'publisher', 'preparer', 'application', 'creation_date'):
+            print(("  {}: {}".format(key, info[key])))
+        if info['el_torito']:
+            print(("  el_torito: {}".format(', '.join(info['el_torito']['platforms']))))
+        print(("  layout: {}".format(', '.join(info['layout']))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
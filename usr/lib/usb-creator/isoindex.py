@@ -0,0 +1,200 @@
+#! /usr/bin/env python3
+
+# Index the directory tree of an ISO without mounting it and find the real
+# kernel and initrd files for the Grub menu.
+# Directory records are read by seeking inside the image (see iso9660.py).
+# Rock Ridge names are used when present, then Joliet, then plain ISO9660.
+# Only the first levels of the tree are walked, which is where boot files
+# live, so only a few KB of metadata are read per ISO.
+# Indexes are cached per ISO digest (volume descriptor and size); only the
+# most recently used indexes are kept.
+#
+# Command line usage:
+# isoindex.py [--cache FILE] "/path/to/your.iso" [...]
+
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
+from os.path import basename, dirname, exists
+from iso9660 import read_volume_info, read_directory, IsoError, SECTOR_SIZE, FIRST_DESCRIPTOR
+
+# Depth of the directory tree that is indexed
+MAX_DEPTH = 4
+# Directories that hold packages, never boot files
+SKIP_DIRS = ('pool', 'dists', 'packages', 'repo', 'rpms')
+# Number of indexes kept in the cache file
+MAX_CACHED_INDEXES = 100
+
+
+# Digest that identifies an ISO: hash of its primary volume descriptor and size
+def iso_digest(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        sha = hashlib.sha256(os.pread(fd, SECTOR_SIZE, FIRST_DESCRIPTOR * SECTOR_SIZE))
+        sha.update(str(os.fstat(fd).st_size).encode())
+    finally:
+        os.close(fd)
+    return sha.hexdigest()
+
+
+# Return the Rock Ridge name (NM entries) of a directory record or None
+def rock_ridge_name(record):
+    name_length = record[32]
+    pos = 33 + name_length + (1 - name_length % 2)
+    name = None
+    while pos + 4 <= len(record):
+        signature = record[pos:pos + 2]
+        length = record[pos + 2]
+        if length < 4:
+            break
+        if signature == b'NM':
+            part = record[pos + 5:pos + length].decode('utf-8', 'replace')
+            name = (name or '') + part
+        elif signature == b'ST':
+            break
+        pos += length
+    return name
+
+
+# Return True when the root directory announces Rock Ridge (SUSP SP entry)
+def has_rock_ridge(fd, root):
+    data = os.pread(fd, 256, root[0] * SECTOR_SIZE)
+    if not data or data[0] < 34:
+        return False
+    record = data[:data[0]]
+    pos = 33 + record[32] + (1 - record[32] % 2)
+    return record[pos:pos + 2] == b'SP' and record[pos + 4:pos + 6] == b'\xbe\xef'
+
+
+# Return the sorted list of file paths of an ISO
+def build_index(path, max_depth=MAX_DEPTH):
+    info = read_volume_info(path)
+    files = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        rock_ridge = has_rock_ridge(fd, info['root'])
+        joliet = info['joliet'] is not None and not rock_ridge
+        root = info['joliet'] if joliet else info['root']
+        # Plain ISO9660 names are upper case: Grub matches them case-insensitively
+        lower = not rock_ridge and not joliet
+        todo = [('', root[0], root[1], 1)]
+        while todo:
+            parent, extent, size, depth = todo.pop()
+            for name, child_extent, child_size, is_dir, record in read_directory(fd, extent, size, joliet):
+                if rock_ridge:
+                    name = rock_ridge_name(record) or name
+                if lower:
+                    name = name.lower()
+                child = '{}/{}'.format(parent, name)
+                if is_dir:
+                    if depth < max_depth and name.lower() not in SKIP_DIRS:
+                        todo.append((child, child_extent, child_size, depth + 1))
+                else:
+                    files.append(child)
+    finally:
+        os.close(fd)
+    return sorted(files)
+
+
+class IndexCache():
+    def __init__(self, cache_path=None, max_indexes=MAX_CACHED_INDEXES):
+        self.cache_path = cache_path
+        self.max_indexes = max_indexes
+        # Digest -> file list, least recently used first
+        self.indexes = {}
+        self.changed = False
+        if cache_path and exists(cache_path):
+            try:
+                with open(cache_path, 'r') as f:
+                    self.indexes = json.load(f)
+            except ValueError:
+                self.indexes = {}
+
+    # Return the file list of an ISO, built when not cached
+    def get(self, path):
+        digest = iso_digest(path)
+        files = self.indexes.pop(digest, None)
+        if files is None:
+            files = build_index(path)
+            self.changed = True
+        elif self.indexes:
+            # Used again: move it to the end
+            self.changed = True
+        self.indexes[digest] = files
+        return files
+
+    def save(self):
+        if not self.cache_path or not self.changed:
+            return
+        # Drop the least recently used indexes
+        digests = list(self.indexes)
+        for digest in digests[:max(0, len(digests) - self.max_indexes)]:
+            del self.indexes[digest]
+        tmp_path = '{}.tmp'.format(self.cache_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.indexes, f)
+        os.replace(tmp_path, self.cache_path)
+        self.changed = False
+
+
+# Return the file of the index that best replaces a boot file path
+def find_boot_file(files, wanted):
+    if wanted in files:
+        return wanted
+    lower_files = dict((f.lower(), f) for f in files)
+    if wanted.lower() in lower_files:
+        return lower_files[wanted.lower()]
+    # A file with the same name start (vmlinuz, initrd, ...) in the same directory,
+    # else a file with the same name in another directory (the shallowest)
+    name = basename(wanted).lower()
+    folder = dirname(wanted).lower()
+    stem = re.split(r'[._]', name)[0]
+    if not stem:
+        return None
+    candidates = [f for f in files
+                  if (dirname(f).lower() == folder and basename(f).lower().startswith(stem)) or
+                  basename(f).lower() == name]
+    if not candidates:
+        return None
+    candidates.sort(key=lambda f: (dirname(f).lower() != folder, f.count('/'), len(f), f))
+    return candidates[0]
+
+
+# Replace the (loop) paths of the linux and initrd lines with files on the ISO
+def resolve_menu_lines(files, linux, initrd):
+    lines = []
+    for line in (linux, initrd):
+        fields = line.split(' ', 2)
+        if len(fields) > 1 and fields[1].startswith('(loop)/'):
+            found = find_boot_file(files, fields[1][len('(loop)'):])
+            if found is not None:
+                fields[1] = '(loop){}'.format(found)
+        lines.append(' '.join(fields))
+    return tuple(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index the files of ISOs without mounting them.')
+    parser.add_argument('--cache', help='Index cache file')
+    parser.add_argument('isos', nargs='+')
+    args = parser.parse_args()
+
+    cache = IndexCache(args.cache)
+    for iso in args.isos:
+        try:
+            files = cache.get(iso)
+        except (OSError, IsoError) as e:
+            print(("{}: {}".format(basename(iso), e)))
+            continue
+        print(("{}: {} files".format(basename(iso), len(files))))
+        for f in files:
+            print(("  {}".format(f)))
+    cache.save()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+
+# List the ISOs of directories (an ISO library or the USB) with their sizes.
+# Directories are read with os.scandir, which takes the file type from the
+# directory entries, so only the ISOs themselves are stat'ed. Listings are
+# cached per directory and read again only when the device, inode or
+# modification time of the directory changed (an ISO was added, removed or
+# renamed; usb-creator renames a copy into place when it is done). vfat
+# keeps a fixed time on its root directory and another stick can be mounted
+# on the same path, so the GUI invalidates the listing of the USB after
+# mounting and writing it. The total size of a listing is updated with the
+# differences between two reads instead of adding up all sizes again.
+#
+# Command line usage:
+# isoscanner.py /path/to/isos [/mount/point]
+
+import os
+import sys
+import stat
+import threading
+from os.path import join, basename
+
+
+class DirectoryListing():
+    def __init__(self, path):
+        self.path = path
+        # (st_dev, st_ino, st_mtime_ns) of the directory when it was read
+        self.key = None
+        # ISO name -> size in kB
+        self.sizes = {}
+        self.total = 0
+
+    # Read the directory again when it changed; returns True when it was read
+    def refresh(self):
+        try:
+            st = os.stat(self.path)
+            key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+        except OSError:
+            key = None
+        if key == self.key:
+            return False
+        sizes = {}
+        if key is not None:
+            try:
+                with os.scandir(self.path) as it:
+                    for entry in it:
+                        # Like the backend's *.iso glob
+                        if entry.name.endswith('.iso') and entry.is_file():
+                            try:
+                                sizes[entry.name] = int(entry.stat().st_size / 1024)
+                            except OSError:
+                                pass
+            except OSError:
+                sizes = {}
+        # Update the total with the differences
+        for name, size in self.sizes.items():
+            if sizes.get(name) != size:
+                self.total -= size
+        for name, size in sizes.items():
+            if self.sizes.get(name) != size:
+                self.total += size
+        self.sizes = sizes
+        self.key = key
+        return True
+
+
+class IsoScanner():
+    def __init__(self):
+        # Directory path -> DirectoryListing
+        self.listings = {}
+        # Used from worker threads
+        self.lock = threading.Lock()
+
+    # Return the listing of a directory, read again only when it changed
+    def get_listing(self, path):
+        with self.lock:
+            listing = self.listings.get(path)
+            if listing is None:
+                listing = self.listings[path] = DirectoryListing(path)
+            listing.refresh()
+            return listing
+
+    # Return the sorted (name, size in kB) of the ISOs in a directory
+    def get_isos(self, path):
+        listing = self.get_listing(path)
+        return sorted(listing.sizes.items())
+
+    # Return (ISO path or '', kB needed on the USB or None when the path does not exist)
+    # path is an ISO or a directory of ISOs; ISOs that are on the USB
+    # (mount) already are replaced, so only the difference is needed
+    def get_required(self, path, mount=''):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return ('', None)
+        usb_sizes = self.get_listing(mount).sizes if mount else {}
+        if stat.S_ISDIR(st.st_mode):
+            listing = self.get_listing(path)
+            if not listing.sizes:
+                return ('', 0)
+            required = listing.total
+            for name, size in listing.sizes.items():
+                required -= usb_sizes.get(name, 0)
+            return (path, max(0, required))
+        return (path, int(st.st_size / 1024) - usb_sizes.get(basename(path), 0))
+
+    # Forget a directory (e.g. after it was mounted or written)
+    def invalidate(self, path):
+        with self.lock:
+            self.listings.pop(path, None)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: isoscanner.py /path/to/isos [/mount/point]")
+        return 2
+    scanner = IsoScanner()
+    mount = sys.argv[2] if len(sys.argv) > 2 else ''
+    if os.path.isdir(sys.argv[1]):
+        for name, size in scanner.get_isos(sys.argv[1]):
+            print(("{}: {} MB".format(join(sys.argv[1], name), int(size / 1024))))
+    path, required = scanner.get_required(sys.argv[1], mount)
+    if required is None:
+        print(("{} does not exist.".format(sys.argv[1])))
+        return 4
+    print(("Required: {} MB".format(int(required / 1024))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,14 +5,84 @@ import pwd
 import logging
 import re
 import sys
+import time
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
 from shutil import move
-from dialogs import ErrorDialog
-from treeview import TreeViewHandler
+
+# Queued mode: records are written in batches by a background thread
+FLUSH_INTERVAL = 0.5
+FLUSH_RECORDS = 200
+
+
+# File handler that collects formatted records and writes them at once
+# Rotates the file (to .old) when it grows beyond maxBytes
+class BatchFileHandler(logging.Handler):
+    def __init__(self, path, maxBytes=None, flushRecords=FLUSH_RECORDS):
+        super(BatchFileHandler, self).__init__()
+        self.path = path
+        self.maxBytes = maxBytes
+        self.flushRecords = flushRecords
+        self.buffer = []
+
+    def emit(self, record):
+        try:
+            self.buffer.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self.buffer) >= self.flushRecords:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = '\n'.join(self.buffer) + '\n'
+        self.buffer = []
+        try:
+            with open(self.path, 'a') as f:
+                f.write(data)
+                size = f.tell()
+            if self.maxBytes is not None and size > self.maxBytes:
+                move(self.path, "%s.old" % self.path)
+        except OSError as e:
+            print(('Cannot write log file %s: %s' % (self.path, e)))
+
+    def close(self):
+        self.flush()
+        super(BatchFileHandler, self).close()
+
+
+# Queue listener that flushes its handlers when no record came in for a while
+class BatchQueueListener(QueueListener):
+    def __init__(self, logQueue, *handlers, flushInterval=FLUSH_INTERVAL):
+        super(BatchQueueListener, self).__init__(logQueue, *handlers, respect_handler_level=True)
+        self.flushInterval = flushInterval
+        self.lastFlush = time.monotonic()
+
+    def dequeue(self, block):
+        while True:
+            if time.monotonic() - self.lastFlush >= self.flushInterval:
+                self.flushHandlers()
+            try:
+                return self.queue.get(block, self.flushInterval)
+            except queue.Empty:
+                if not block:
+                    raise
+                self.flushHandlers()
+
+    def flushHandlers(self):
+        self.lastFlush = time.monotonic()
+        for handler in self.handlers:
+            handler.flush()
 
 
 class Logger():
 
-    def __init__(self, logPath='', defaultLogLevel='debug', addLogTime=True, rtObject=None, parent=None, maxSizeKB=None):
+    # With queued=True the calling thread only puts records on a queue:
+    # a background thread formats and writes them in batches
+    def __init__(self, logPath='', defaultLogLevel='debug', addLogTime=True, rtObject=None, parent=None, maxSizeKB=None, queued=False):
         self.logPath = logPath
         if self.logPath != '':
             if self.logPath[:1] != '/':
@@ -24,8 +94,12 @@ class Logger():
         self.typeString = self.getTypeString(self.rtobject)
         self.parent = parent
         self.maxSizeKB = maxSizeKB
+        self.queued = queued
+        self.listener = None
 
-        if self.logPath == '':
+        if self.logPath != '' and self.queued:
+            self.startListener(addLogTime)
+        elif self.logPath == '':
             # Log only to console
             logging.basicConfig(level=self.defaultLevel, format='%(levelname)-10s%(message)s')
         else:
@@ -54,12 +128,53 @@ class Logger():
             console.setFormatter(formatter)
             logging.getLogger('').addHandler(console)
 
+    # Log to file and console from a background thread
+    def startListener(self, addLogTime):
+        formatStr = '%(name)-30s%(levelname)-10s%(message)s'
+        dateFmtStr = None
+        if addLogTime:
+            formatStr = '%(asctime)s ' + formatStr
+            dateFmtStr = '%d-%m-%Y %H:%M:%S'
+        maxBytes = None
+        if self.maxSizeKB is not None:
+            maxBytes = self.maxSizeKB * 1024
+        fileHandler = BatchFileHandler(self.logPath, maxBytes)
+        fileHandler.setFormatter(logging.Formatter(formatStr, dateFmtStr))
+        fileHandler.setLevel(self.defaultLevel)
+        # Define a Handler which writes INFO messages or higher to the console
+        console = logging.StreamHandler()
+        console.setLevel(logging.INFO)
+        console.setFormatter(logging.Formatter('%(levelname)-10s%(message)s'))
+
+        logQueue = queue.Queue(-1)
+        root = logging.getLogger('')
+        root.setLevel(self.defaultLevel)
+        root.addHandler(QueueHandler(logQueue))
+        self.listener = BatchQueueListener(logQueue, fileHandler, console)
+        self.listener.start()
+        atexit.register(self.close)
+
+    # Write the queued records and stop the background thread
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+
     # Write message
-    def write(self, message, loggerName='log', logLevel='debug', showErrorDialog=True):
+    # msgArgs are formatted into message (str.format) only when the level is logged
+    def write(self, message, loggerName='log', logLevel='debug', showErrorDialog=True, msgArgs=None):
+        logLevel = logLevel.lower()
+        myLogger = logging.getLogger(loggerName)
+        level = logging.ERROR if logLevel == 'exception' else getattr(logging, logLevel.upper(), logging.DEBUG)
+        # Debug messages that are not logged are not even formatted
+        if level < logging.INFO and not myLogger.isEnabledFor(level):
+            return
+        if msgArgs is not None:
+            message = message.format(*msgArgs)
         message = str(message).strip()
         if message != '':
-            logLevel = logLevel.lower()
-            myLogger = logging.getLogger(loggerName)
             if logLevel == 'debug':
                 myLogger.debug(message)
             elif logLevel == 'info':
@@ -72,22 +187,23 @@ class Logger():
                 myLogger.error(message)
                 self.rtobjectWrite(message)
                 if showErrorDialog:
-                    ErrorDialog('Error', message)
+                    self.showErrorDialog('Error', message)
             elif logLevel == 'critical':
                 myLogger.critical(message)
                 self.rtobjectWrite(message)
                 if showErrorDialog:
-                    ErrorDialog('Critical', message)
+                    self.showErrorDialog('Critical', message)
             elif logLevel == 'exception':
                 myLogger.exception(message)
                 self.rtobjectWrite(message)
                 if showErrorDialog:
-                    ErrorDialog('Exception', message)
-            # Flush now
-            try:
-                sys.stdout.flush()
-            except:
-                pass
+                    self.showErrorDialog('Exception', message)
+            # Flush now (the console handler flushes in queued mode)
+            if not self.queued:
+                try:
+                    sys.stdout.flush()
+                except:
+                    pass
 
     # Return messge to given object
     def rtobjectWrite(self, message):
@@ -95,6 +211,8 @@ class Logger():
             if 'label' in self.typeString.lower():
                 self.rtobject.set_text(message)
             elif 'treeview' in self.typeString.lower():
+                # Gtk is only imported when a treeview is used
+                from treeview import TreeViewHandler
                 tvHandler = TreeViewHandler(self.rtobject)
                 tvHandler.fillTreeview([message], ['str'], [-1], 0, 400, False, True, True, fontSize=10000)
             elif 'statusbar' in self.typeString.lower():
@@ -103,6 +221,11 @@ class Logger():
                 # For obvious reasons: do not log this...
                 print(('Return object type not implemented: %s' % self.typeString))
 
+    # Gtk is only imported when a dialog is shown
+    def showErrorDialog(self, title, message):
+        from dialogs import ErrorDialog
+        ErrorDialog(title, message)
+
     # Return the type string of a object
     def getTypeString(self, object):
         tpString = ''
@@ -1,13 +1,24 @@
 #! /usr/bin/env python3 -OO
 
+import sys
+from startup import StartupProfiler
+# Print the time of each start up phase with --profile-startup
+profiler = StartupProfiler('--profile-startup' in sys.argv)
+
+# Commands of the headless entry point do not need Gtk or a display
+import cli
+if len(sys.argv) > 1 and sys.argv[1] in cli.COMMANDS:
+    sys.exit(cli.main())
+
 # Make sure the right Gtk version is loaded
 import gi
 gi.require_version('Gtk', '3.0')
 
-import sys
 from dialogs import ErrorDialog
 from gi.repository import Gtk, GObject
+profiler.mark('import Gtk')
 from usbcreator import USBCreator
+profiler.mark('import usbcreator')
 
 
 # i18n: http://docs.python.org/3/library/gettext.html
@@ -55,7 +66,7 @@ if __name__ == "__main__":
         # Debian Jessie: 3.4.2
         GObject.threads_init()
 
-        USBCreator()
+        USBCreator(profiler)
         Gtk.main()
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+
+# Overlap reading the source and writing the target.
+# A reader thread and the writer (the calling thread) pass preallocated,
+# page aligned buffers through two bounded queues: the reader fills a free
+# buffer and queues it, the writer writes it and hands it back. No buffer is
+# allocated or copied while the data flows.
+# The time each side waits on the other is measured: when the writer mostly
+# waits for data the source limits the throughput, when the reader mostly
+# waits for a free buffer the target (the USB) does.
+
+import mmap
+import time
+import queue
+import threading
+
+# Default number of buffers in flight
+DEFAULT_BUFFER_COUNT = 4
+# Buffers are page aligned, which satisfies O_DIRECT
+PAGE_SIZE = mmap.PAGESIZE
+
+
+class BufferPipeline():
+    def __init__(self, buffer_size, buffer_count=DEFAULT_BUFFER_COUNT):
+        self.buffer_size = max(PAGE_SIZE, (int(buffer_size) // PAGE_SIZE) * PAGE_SIZE)
+        # Two buffers are needed to overlap
+        self.buffer_count = max(2, int(buffer_count))
+        # Seconds the writer waited for data and the reader for a free buffer
+        self.read_wait = 0.0
+        self.write_wait = 0.0
+
+    # Run the pipeline until read_func reports the end of the data
+    # read_func(view) runs in the reader thread: it fills the view and
+    # returns (bytes read, tag); 0 bytes ends the pipeline.
+    # write_func(view, n, tag) runs in the calling thread.
+    # Exceptions of either side are raised in the calling thread.
+    def run(self, read_func, write_func):
+        self.read_wait = 0.0
+        self.write_wait = 0.0
+        buffers = [mmap.mmap(-1, self.buffer_size) for i in range(self.buffer_count)]
+        views = [memoryview(buf) for buf in buffers]
+        free = queue.Queue(self.buffer_count + 1)
+        full = queue.Queue(self.buffer_count + 1)
+        for index in range(self.buffer_count):
+            free.put(index)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read, args=(read_func, views, free, full, stop))
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                start = time.monotonic()
+                item = full.get()
+                self.read_wait += time.monotonic() - start
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                index, n, tag = item
+                write_func(views[index], n, tag)
+                free.put(index)
+        finally:
+            # Stops the reader when writing failed
+            stop.set()
+            free.put(None)
+            reader.join()
+            for view in views:
+                view.release()
+            for buf in buffers:
+                buf.close()
+
+    def _read(self, read_func, views, free, full, stop):
+        try:
+            while True:
+                start = time.monotonic()
+                index = free.get()
+                self.write_wait += time.monotonic() - start
+                if index is None or stop.is_set():
+                    return
+                n, tag = read_func(views[index])
+                if n == 0:
+                    full.put(None)
+                    return
+                full.put((index, n, tag))
+        except Exception as e:
+            full.put(e)
+
+    # Wait times for progress events
+    def stats(self):
+        return {'blocked_read': round(self.read_wait, 3),
+                'blocked_write': round(self.write_wait, 3)}
+
+
+# Human readable summary of the wait times
+def format_stats(event):
+    if 'blocked_read' not in event:
+        return ''
+    return "waited {:.1f} s on the source, {:.1f} s on the target".format(event['blocked_read'],
+                                                                         event['blocked_write'])
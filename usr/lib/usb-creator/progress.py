@@ -0,0 +1,93 @@
+#! /usr/bin/env python3
+
+# Machine readable progress from the backend to the GUI.
+# The GUI passes the write end of a pipe to usb-creator and sets
+# USB_CREATOR_PROGRESS_FD to its file descriptor number. The backend and its
+# Python helpers write one JSON object per line to that descriptor:
+# {"phase": "copy", "bytes_done": 1048576, "bytes_total": 4194304, "rate": 524288, "eta": 6.0}
+# Only "phase" is required. The GUI reads the records with a GLib IO watch.
+
+import os
+import json
+
+PROGRESS_FD_ENV = 'USB_CREATOR_PROGRESS_FD'
+
+
+class ProgressWriter():
+    def __init__(self, fd=None):
+        self.fd = fd
+
+    # Return a writer for the descriptor passed in the environment
+    # (a writer that does nothing when there is none)
+    @classmethod
+    def from_environment(cls):
+        fd = None
+        try:
+            fd = int(os.environ.get(PROGRESS_FD_ENV, ''))
+            os.fstat(fd)
+        except (ValueError, OSError):
+            fd = None
+        return cls(fd)
+
+    def enabled(self):
+        return self.fd is not None
+
+    def emit(self, record):
+        if self.fd is None:
+            return
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        try:
+            os.write(self.fd, line)
+        except OSError:
+            # The reader is gone: stop reporting
+            self.fd = None
+
+
+class ProgressReader():
+    def __init__(self, fd, callback):
+        # Called with each record (dictionary) on the GLib main loop
+        self.fd = fd
+        self.callback = callback
+        self.buffer = b''
+        self.watch_id = 0
+
+    def start(self):
+        from gi.repository import GLib
+        self.watch_id = GLib.io_add_watch(self.fd, GLib.PRIORITY_DEFAULT,
+                                          GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR,
+                                          self.on_readable)
+
+    def stop(self):
+        if self.watch_id:
+            from gi.repository import GLib
+            GLib.source_remove(self.watch_id)
+            self.watch_id = 0
+            self._close()
+
+    def on_readable(self, fd, condition):
+        data = b''
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            pass
+        if not data:
+            # All writers closed the pipe
+            self.watch_id = 0
+            self._close()
+            return False
+        self.buffer += data
+        lines = self.buffer.split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            if isinstance(record, dict) and 'phase' in record:
+                self.callback(record)
+        return True
+
+    def _close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
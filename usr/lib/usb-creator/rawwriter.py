@@ -0,0 +1,371 @@
+#! /usr/bin/env python3
+
+# Write a raw image to a device with large sequential writes.
+# The whole image is written, holes of a sparse image as zeros, so nothing
+# of the old contents of the device is left. The written data can be
+# verified by reading the device back without the page cache against a list
+# of hashes of the parts of the image, which can be computed once for an
+# image or while writing.
+# The image is read by a second thread while the device is written
+# (see pipeline.py). With --skip-zeros a device that can zero ranges itself
+# (write zeroes offload) is zeroed once with BLKZEROOUT and blocks that only
+# hold zeros (like the holes of a sparse image) are not written at all.
+# File system images (golden images) can be written sparse: only their data
+# extents (SEEK_DATA/SEEK_HOLE) are written and hashed. Their holes are free
+# space of the file system, so the old contents of the device can stay there.
+#
+# Command line usage (used by the usb-creator backend for -c):
+# rawwriter.py [--hashes FILE] [--verify] [--skip-zeros] /path/to/image /dev/sdb
+
+import os
+import sys
+import json
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import argparse
+from os.path import exists, join, basename, dirname
+from copyengine import fill_buffer, ALIGNMENT
+from pipeline import BufferPipeline, DEFAULT_BUFFER_COUNT, format_stats
+from progress import ProgressWriter
+
+# Large blocks are written fastest to flash: 16 MB
+DEFAULT_BUFFER_SIZE = 16 * 1024 * 1024
+# Extents are hashed in parts of at most 64 MB
+HASH_CHUNK_SIZE = 64 * 1024 * 1024
+# Blocks of 1 MB that only hold zeros are skipped after zeroing the device
+ZERO_BLOCK_SIZE = 1024 * 1024
+ZERO_BLOCK = bytes(ZERO_BLOCK_SIZE)
+# ioctl to zero a range of a block device: _IO(0x12, 127)
+BLKZEROOUT = 0x127f
+SECTOR_SIZE = 512
+# Exit codes of the command line
+EXIT_MISMATCH = 7
+EXIT_WRITE = 12
+
+
+# Return the (offset, length) of the data in a file
+# Without SEEK_DATA support the whole file is data
+def data_extents(fd, size):
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)] if size else []
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                # ENXIO: no data after offset
+                if e.errno == 6:
+                    break
+                raise
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            extents.append((start, end - start))
+            offset = end
+    except OSError:
+        return [(0, size)] if size else []
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+    return extents
+
+
+# Return the extents of an image that are written: all of it or its data
+def image_extents(fd, size, sparse=False):
+    if sparse:
+        return data_extents(fd, size)
+    return [(0, size)] if size else []
+
+
+# O_DIRECT needs extents that start on a block boundary
+def aligned(extents):
+    return not [offset for offset, length in extents if offset % ALIGNMENT]
+
+
+# Size of a file or block device
+def get_size(fd):
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+# True when the device zeroes ranges itself (write zeroes offload)
+# Without it BLKZEROOUT writes the zeros, which is as slow as writing them here
+def zeroes_offloaded(device):
+    sys_path = os.path.realpath('/sys/class/block/{}'.format(basename(os.path.realpath(device))))
+    for path in (sys_path, dirname(sys_path)):
+        try:
+            with open(join(path, 'queue/write_zeroes_max_bytes'), 'r') as f:
+                return int(f.read().strip()) > 0
+        except (OSError, ValueError):
+            pass
+    return False
+
+
+# Zero the first size bytes of a block device
+# Returns False when the device does not support it
+def zero_out(fd, size):
+    size = min(((size + SECTOR_SIZE - 1) // SECTOR_SIZE) * SECTOR_SIZE, get_size(fd))
+    try:
+        fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', 0, size))
+    except OSError:
+        return False
+    return True
+
+
+# Split a block in runs of (zero, start, end) of ZERO_BLOCK_SIZE blocks
+def zero_runs(view, n):
+    runs = []
+    for start in range(0, n, ZERO_BLOCK_SIZE):
+        end = min(start + ZERO_BLOCK_SIZE, n)
+        zero = view[start:end].tobytes() == ZERO_BLOCK[:end - start]
+        if runs and runs[-1][0] == zero:
+            runs[-1][2] = end
+        else:
+            runs.append([zero, start, end])
+    return runs
+
+
+# Return the hash list of an image: one entry per part of chunk_size
+# Holes are hashed as the zeros they read as, or left out when sparse
+def hash_extents(path, chunk_size=HASH_CHUNK_SIZE, sparse=False):
+    hashes = []
+    buf = bytearray(DEFAULT_BUFFER_SIZE)
+    view = memoryview(buf)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = get_size(fd)
+        for offset, length in image_extents(fd, size, sparse):
+            end = offset + length
+            while offset < end:
+                part = min(chunk_size, end - offset)
+                sha = hashlib.sha256()
+                done = 0
+                while done < part:
+                    n = os.preadv(fd, [view[:min(len(buf), part - done)]], offset + done)
+                    if n == 0:
+                        break
+                    sha.update(view[:n])
+                    done += n
+                hashes.append({'offset': offset, 'length': done, 'sha256': sha.hexdigest()})
+                offset += part
+    finally:
+        view.release()
+        os.close(fd)
+    return hashes
+
+
+class RawWriter():
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, direct=True, skip_zeros=False,
+                 progress_callback=None, progress_interval=0.5, buffer_count=DEFAULT_BUFFER_COUNT):
+        self.buffer_size = max(ALIGNMENT, (int(buffer_size) // ALIGNMENT) * ALIGNMENT)
+        # Buffers in flight between the reader and the writer thread
+        self.buffer_count = buffer_count
+        self.direct = direct and hasattr(os, 'O_DIRECT')
+        self.skip_zeros = skip_zeros
+        # Called with an event dictionary
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        # Filled by write(): hash list of what was read and bytes not written
+        self.hashes = []
+        self.skipped = 0
+
+    # Write source to device; returns the number of bytes written
+    # sparse: only write the data extents and leave the device as it is in the holes
+    def write(self, source, device, sparse=False):
+        src_fd = os.open(source, os.O_RDONLY)
+        try:
+            size = get_size(src_fd)
+            # Else holes are read as zeros and written (or skipped after zeroing)
+            extents = image_extents(src_fd, size, sparse)
+            flags = os.O_WRONLY
+            if self.direct and aligned(extents):
+                flags |= os.O_DIRECT
+            dst_fd = os.open(device, flags)
+            try:
+                if get_size(dst_fd) < size:
+                    raise OSError(28, "{} is smaller than {}".format(device, source))
+                # Zeros can only be skipped when the whole range was zeroed by the device
+                skip_zeros = self.skip_zeros and zeroes_offloaded(device) and zero_out(dst_fd, size)
+                done = self._write_extents(src_fd, dst_fd, source, extents, skip_zeros)
+                os.fsync(dst_fd)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        return done
+
+    def _write_extents(self, src_fd, dst_fd, source, extents, skip_zeros=False):
+        total = sum(length for offset, length in extents)
+        done = 0
+        last_report = 0
+        self.hashes = []
+        self.skipped = 0
+        start = time.monotonic()
+        # The image is read (and hashed) in a second thread while the device is written
+        pipeline = BufferPipeline(self.buffer_size, self.buffer_count)
+        todo = [list(extent) for extent in reversed(extents)]
+        part = {'offset': 0, 'sha': None}
+        self._emit('start', source, done, total, start)
+
+        # Read the next block of the extents; hashed in parts like hash_extents()
+        def read(view):
+            while todo:
+                offset, length = todo[-1]
+                if part['sha'] is None:
+                    part['offset'] = offset
+                    part['sha'] = hashlib.sha256()
+                part_left = part['offset'] + HASH_CHUNK_SIZE - offset
+                os.lseek(src_fd, offset, os.SEEK_SET)
+                n = fill_buffer(src_fd, view[:min(self.buffer_size, length, part_left)])
+                if n:
+                    part['sha'].update(view[:n])
+                    todo[-1] = [offset + n, length - n]
+                if n == 0 or n == length or n == part_left:
+                    if offset + n > part['offset']:
+                        self.hashes.append({'offset': part['offset'], 'length': offset + n - part['offset'],
+                                            'sha256': part['sha'].hexdigest()})
+                    part['sha'] = None
+                    if n == 0 or n == length:
+                        # End of the extent (or of a short image)
+                        todo.pop()
+                if n:
+                    return n, offset
+            return 0, None
+
+        def write(view, n, offset):
+            nonlocal done, last_report
+            if n % ALIGNMENT and fcntl.fcntl(dst_fd, fcntl.F_GETFL) & os.O_DIRECT:
+                # Unaligned end of the image: finish without O_DIRECT
+                fl = fcntl.fcntl(dst_fd, fcntl.F_GETFL)
+                fcntl.fcntl(dst_fd, fcntl.F_SETFL, fl & ~os.O_DIRECT)
+            runs = zero_runs(view, n) if skip_zeros else [[False, 0, n]]
+            for zero, run_start, run_end in runs:
+                if zero:
+                    self.skipped += run_end - run_start
+                    continue
+                written = run_start
+                while written < run_end:
+                    written += os.pwrite(dst_fd, view[written:run_end], offset + written)
+            done += n
+            now = time.monotonic()
+            if now - last_report >= self.progress_interval:
+                last_report = now
+                self._emit('progress', source, done, total, start, pipeline.stats())
+
+        pipeline.run(read, write)
+        self._emit('done', source, done, total, start, pipeline.stats())
+        return done
+
+    # Read the device back and compare it with the hash list
+    # Returns the hash entries that do not match
+    def verify(self, device, hashes):
+        mismatches = []
+        buf = mmap.mmap(-1, self.buffer_size)
+        view = memoryview(buf)
+        flags = os.O_RDONLY
+        if self.direct and aligned([(e['offset'], e['length']) for e in hashes]):
+            flags |= os.O_DIRECT
+        fd = os.open(device, flags)
+        try:
+            for entry in hashes:
+                sha = hashlib.sha256()
+                done = 0
+                length = entry['length']
+                while done < length:
+                    # O_DIRECT reads whole blocks: read aligned and use what is needed
+                    want = min(self.buffer_size, length - done)
+                    read_size = ((want + ALIGNMENT - 1) // ALIGNMENT) * ALIGNMENT
+                    n = os.preadv(fd, [view[:read_size]], entry['offset'] + done)
+                    if n == 0:
+                        break
+                    n = min(n, want)
+                    sha.update(view[:n])
+                    done += n
+                if sha.hexdigest() != entry['sha256']:
+                    mismatches.append(entry)
+        finally:
+            os.close(fd)
+            view.release()
+            buf.close()
+        return mismatches
+
+    def _emit(self, event, source, done, total, start, stats=None):
+        if self.progress_callback is None:
+            return
+        elapsed = time.monotonic() - start
+        rate = done / elapsed if elapsed > 0 else 0
+        eta = (total - done) / rate if rate > 0 else None
+        record = {'event': event,
+                  'phase': 'write',
+                  'source': source,
+                  'bytes_done': done,
+                  'bytes_total': total,
+                  'rate': int(rate),
+                  'eta': eta}
+        if stats:
+            record.update(stats)
+        self.progress_callback(record)
+
+
+# Human readable progress for the log
+def print_progress(event):
+    if event['event'] == 'start':
+        print(("Writing {} MB of {}...".format(int(event['bytes_total'] / 1048576), event['source'])))
+    elif event['event'] == 'progress':
+        print(("MB written: {} / {} ({:.1f} MB/s)".format(int(event['bytes_done'] / 1048576),
+                                                          int(event['bytes_total'] / 1048576),
+                                                          event['rate'] / 1048576)))
+    elif event['event'] == 'done':
+        print(("Write finished: {} ({:.1f} MB/s, {})".format(event['source'], event['rate'] / 1048576,
+                                                             format_stats(event))))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the data of a raw image to a device.')
+    parser.add_argument('--hashes', help='Per-extent hash list of the image (JSON)')
+    parser.add_argument('--verify', action='store_true', help='Read the device back and check it')
+    parser.add_argument('--skip-zeros', action='store_true',
+                        help='Zero the device when it can do so itself and do not write blocks of zeros')
+    parser.add_argument('--buffer-size', type=int, default=DEFAULT_BUFFER_SIZE // 1048576,
+                        help='Size of the write buffer in MB')
+    parser.add_argument('--buffer-count', type=int, default=DEFAULT_BUFFER_COUNT,
+                        help='Number of buffers between the reader and the writer')
+    parser.add_argument('image')
+    parser.add_argument('device')
+    args = parser.parse_args()
+
+    # Progress goes to stdout (log file) and to the GUI's progress channel
+    channel = ProgressWriter.from_environment()
+
+    def report(event):
+        print_progress(event)
+        channel.emit(event)
+
+    writer = RawWriter(buffer_size=args.buffer_size * 1048576, skip_zeros=args.skip_zeros,
+                       progress_callback=report, buffer_count=args.buffer_count)
+    try:
+        writer.write(args.image, args.device)
+    except OSError as e:
+        print(("Writing {} to {} failed: {}".format(args.image, args.device, e)))
+        return EXIT_WRITE
+    if writer.skipped:
+        print(("Blocks of zeros not written: {} MB".format(int(writer.skipped / 1048576))))
+    if args.verify:
+        channel.emit({'phase': 'verify'})
+        if args.hashes and exists(args.hashes):
+            with open(args.hashes, 'r') as f:
+                hashes = json.load(f)['extents']
+        else:
+            # Hashed while writing: only the device is read
+            hashes = writer.hashes
+        if writer.verify(args.device, hashes):
+            print(("{} does NOT match {}".format(args.device, args.image)))
+            return EXIT_MISMATCH
+        print(("{} matches {}".format(args.device, args.image)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,32 @@
+#! /usr/bin/env python3
+
+# Time the phases of the start up of the GUI (main.py --profile-startup).
+# Every mark() records the time since the previous mark; report() prints
+# the breakdown once the window is usable.
+
+import sys
+import time
+
+
+class StartupProfiler():
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.start = time.monotonic()
+        self.last = self.start
+        self.phases = []
+
+    def mark(self, phase):
+        if self.enabled:
+            now = time.monotonic()
+            self.phases.append((phase, now - self.last))
+            self.last = now
+
+    def report(self):
+        if not self.enabled:
+            return
+        print("Startup profile:")
+        for phase, seconds in self.phases:
+            print(("  {:<30} {:8.1f} ms".format(phase, seconds * 1000)))
+        print(("  {:<30} {:8.1f} ms".format('total', (self.last - self.start) * 1000)))
+        sys.stdout.flush()
+        self.enabled = False
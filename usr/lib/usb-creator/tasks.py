@@ -0,0 +1,64 @@
+#! /usr/bin/env python3
+
+# Run blocking work (usb-creator, mounts, directory scans) off the GTK main loop.
+# Tasks run in a small thread pool. Their result (or exception) is handed to
+# a callback on the GLib main loop with GLib.idle_add, so callbacks can
+# update widgets. Tasks started with a key replace the previous task with
+# that key: a task that did not start yet is cancelled and the result of a
+# task that was already running is dropped.
+
+from concurrent.futures import ThreadPoolExecutor
+from gi.repository import GLib
+
+DEFAULT_WORKERS = 4
+
+
+class TaskRunner():
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Key -> latest future started with that key
+        self.latest = {}
+
+    # Run func(*args) in a worker thread
+    # callback(result) or error_callback(exception) is called on the main loop
+    def run(self, func, args=(), callback=None, error_callback=None, key=None):
+        if key is not None:
+            self.cancel(key)
+        future = self.executor.submit(func, *args)
+        if key is not None:
+            self.latest[key] = future
+        future.add_done_callback(lambda f: GLib.idle_add(self._done, f, key, callback, error_callback))
+        return future
+
+    # Cancel the task with this key (its callback is not called)
+    def cancel(self, key):
+        future = self.latest.pop(key, None)
+        if future is not None:
+            future.cancel()
+
+    # True while the callback of the task with this key was not called
+    def is_pending(self, key):
+        return key in self.latest
+
+    def _done(self, future, key, callback, error_callback):
+        if key is not None:
+            if self.latest.get(key) is not future:
+                # Replaced by a newer task
+                return False
+            del self.latest[key]
+        if future.cancelled():
+            return False
+        error = future.exception()
+        if error is not None:
+            if error_callback is not None:
+                error_callback(error)
+            else:
+                print(("Task failed: {}".format(error)))
+        elif callback is not None:
+            callback(future.result())
+        return False
+
+    def shutdown(self):
+        for key in list(self.latest):
+            self.cancel(key)
+        self.executor.shutdown(wait=False)
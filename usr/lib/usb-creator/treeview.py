@@ -7,6 +7,37 @@ gi.require_version('Gtk', '3.0')
 import os
 from gi.repository import Gtk, GObject, GdkPixbuf
 
+# Column type names of fillTreeview
+COLUMN_TYPES = {'str': str,
+                'bool': bool,
+                'int': int,
+                'float': float,
+                'GdkPixbuf.Pixbuf': GdkPixbuf.Pixbuf}
+
+# Loaded pixbufs: (path, height) -> pixbuf
+_pixbufs = {}
+
+
+# Return the list store type of a column type name (or type)
+def getColumnType(columnType):
+    return COLUMN_TYPES.get(str(columnType), columnType)
+
+
+# Return the pixbuf of an image file (None when it does not exist)
+# The pixbuf is loaded once, optionally scaled to a fixed height
+def getPixbuf(path, fixedImgHeight=None):
+    key = (path, fixedImgHeight)
+    if key not in _pixbufs:
+        pb = None
+        if os.path.isfile(path):
+            pb = GdkPixbuf.Pixbuf.new_from_file(path)
+            if fixedImgHeight:
+                nw = int(pb.get_width() * (fixedImgHeight / pb.get_height()))
+                pb = pb.scale_simple(nw, fixedImgHeight, GdkPixbuf.InterpType.BILINEAR)
+        _pixbufs[key] = pb
+    return _pixbufs[key]
+
+
 # Treeview needs subclassing of gobject
 # http://www.pygtk.org/articles/subclassing-gobject/sub-classing-gobject-in-python.htm
 
@@ -40,6 +71,7 @@ class TreeViewHandler(GObject.GObject):
         # Check if this is a multi-dimensional array
         multiCols = self.isListOfLists(contentList)
         colNameList = []
+        columnTypes = [getColumnType(t) for t in columnTypesList]
 
         if len(contentList) == 0 or (len(self.treeview.get_columns()) !=  len(columnTypesList)):
             # Empty treeview
@@ -47,38 +79,25 @@ class TreeViewHandler(GObject.GObject):
 
         liststore = self.treeview.get_model()
         if liststore is None or not appendToExisting:
-            # Dirty but need to dynamically create a list store
             for col in self.treeview.get_columns():
                 self.treeview.remove_column(col)
-            dynListStore = 'Gtk.ListStore('
-            for i in range(len(columnTypesList)):
-                dynListStore += str(columnTypesList[i]) + ', '
-            dynListStore += 'int, int)'
-            msg = "Create list store eval string: %(eval)s" % { "eval": dynListStore }
+            # Data columns plus the weight and font size columns
+            liststore = Gtk.ListStore(*(columnTypes + [int, int]))
+            msg = "Create list store: %(types)s" % { "types": str(columnTypesList) }
             print(msg)
             if self.log:
                 self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-            liststore = eval(dynListStore)
 
         # Create list with column names
         if not appendToExisting:
             if multiCols:
-                #for i in range(len(contentList[0])):
                 for i in range(len(columnTypesList)):
                     if firstItemIsColName and len(contentList) > 0:
-                        msg = "First item is column name (multi-column list): %(iscolname)s" % { "iscolname": contentList[0][i] }
-                        print(msg)
-                        if self.log:
-                            self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
                         colNameList.append(contentList[0][i])
                     else:
                         colNameList.append('Column ' + str(i))
             else:
                 if firstItemIsColName and len(contentList) > 0:
-                    msg = "First item is column name (single-column list): %(iscolname)s" % { "iscolname": contentList[0] }
-                    print(msg)
-                    if self.log:
-                        self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
                     colNameList.append(contentList[0])
                 else:
                     colNameList.append('Column 0')
@@ -88,66 +107,36 @@ class TreeViewHandler(GObject.GObject):
             if self.log:
                 self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
 
-        # Add data to the list store
+        # Convert the data to rows of the list store
+        rows = []
+        weightRow = setCursor
+        if firstItemIsColName:
+            weightRow += 1
         for i in range(len(contentList)):
             # Skip first row if that is a column name
-            skip = False
             if firstItemIsColName and i == 0:
-                msg = "First item is column name: skip first item"
-                print(msg)
-                if self.log:
-                    self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                skip = True
-
-            if not skip:
-                weight = 400
-                weightRow = setCursor
-                if firstItemIsColName:
-                    weightRow += 1
-                if i == weightRow:
-                    weight = setCursorWeight
-                if multiCols:
-                    # Dynamically add data for multi-column list store
-                    if appendToTop:
-                        dynListStoreAppend = 'liststore.insert(0, ['
-                    else:
-                        dynListStoreAppend = 'liststore.append(['
-                    for j in range(len(contentList[i])):
-                        val = str(contentList[i][j]).strip()
-                        if str(columnTypesList[j]) == 'str':
-                            # Make sure it's a single line
-                            val = '"' + val.replace('\n', ' ').replace('\r', '').replace('"', '\\"') + '"'
-                        if str(columnTypesList[j]) == 'GdkPixbuf.Pixbuf':
-                            if os.path.isfile(val):
-                                if fixedImgHeight:
-                                    pb = GdkPixbuf.Pixbuf.new_from_file(val)
-                                    nw = pb.get_width() * (fixedImgHeight / pb.get_height())
-                                    val = 'GdkPixbuf.Pixbuf.new_from_file("%(val)s").scale_simple(%(width)s, %(height)s, GdkPixbuf.InterpType.BILINEAR)' % { "val": val, "width": nw, "height": fixedImgHeight }
-                                else:
-                                    val = 'GdkPixbuf.Pixbuf.new_from_file("%(val)s")' % { "val": val }
-                            else:
-                                val = None
-                        dynListStoreAppend += '%s, ' % val
-                    dynListStoreAppend += '%s, %s])' % (str(weight), fontSize)
-
-                    msg = "Add data to list store: %(data)s" % { "data": dynListStoreAppend }
-                    #print(msg)
-                    if self.log:
-                        self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                    eval(dynListStoreAppend)
-                else:
-                    if appendToTop:
-                        msg = "Add data to top of list store: %(totop)s" % { "totop": str(contentList[i]) }
-                        #print(msg)
-                        if self.log:
-                            self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                        liststore.insert(0, [contentList[i], weight, fontSize])
-                    else:
-                        msg = "Add data to bottom of list store: %(tobottom)s" % { "tobottom": str(contentList[i]) }
-                        #print(msg)
-                        if self.log:
-                            self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                        liststore.append([contentList[i], weight, fontSize])
+                continue
+            weight = 400
+            if i == weightRow:
+                weight = setCursorWeight
+            if multiCols:
+                row = [self.toColumnValue(contentList[i][j], columnTypes[j], fixedImgHeight)
+                       for j in range(len(contentList[i]))]
+            else:
+                row = [contentList[i]]
+            rows.append(row + [weight, fontSize])
+
+        # Add the rows while the list store is detached from the treeview
+        self.treeview.set_model(None)
+        if appendToTop:
+            for row in rows:
+                liststore.insert(0, row)
+        else:
+            for row in rows:
+                liststore.append(row)
+        msg = "Rows added to list store: %(rows)d" % { "rows": len(rows) }
+        if self.log:
+            self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
 
         # Create columns
         if not appendToExisting:
@@ -163,28 +152,28 @@ class TreeViewHandler(GObject.GObject):
                 if colFound == '':
                     # Build renderer and attributes to define the column
                     # Possible attributes for text: text, foreground, background, weight
-                    attr = ', text=' + str(i) + ', weight=' + str(len(colNameList)) + ', size=' + str(len(colNameList) + 1)
-                    renderer = 'Gtk.CellRendererText()'  # an object that renders text into a Gtk.TreeView cell
-                    if str(columnTypesList[i]) == 'bool':
-                        renderer = 'Gtk.CellRendererToggle()'  # an object that renders a toggle button into a TreeView cell
-                        attr = ', active=' + str(i)
-                    if str(columnTypesList[i]) == 'GdkPixbuf.Pixbuf':
-                        renderer = 'Gtk.CellRendererPixbuf()'  # an object that renders a pixbuf into a Gtk.TreeView cell
-                        attr = ', pixbuf=' + str(i)
-                    dynCol = 'Gtk.TreeViewColumn("' + str(colNameList[i]) + '", ' + renderer + attr + ')'
-
-                    msg = "Create column: %(col)s" % { "col": dynCol }
+                    if columnTypes[i] is bool:
+                        # An object that renders a toggle button into a TreeView cell
+                        col = Gtk.TreeViewColumn(str(colNameList[i]), Gtk.CellRendererToggle(), active=i)
+                    elif columnTypes[i] is GdkPixbuf.Pixbuf:
+                        # An object that renders a pixbuf into a Gtk.TreeView cell
+                        col = Gtk.TreeViewColumn(str(colNameList[i]), Gtk.CellRendererPixbuf(), pixbuf=i)
+                    else:
+                        # An object that renders text into a Gtk.TreeView cell
+                        col = Gtk.TreeViewColumn(str(colNameList[i]), Gtk.CellRendererText(), text=i,
+                                                 weight=len(colNameList), size=len(colNameList) + 1)
+
+                    msg = "Create column: %(col)s" % { "col": col.get_title() }
                     print(msg)
                     if self.log:
                         self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                    col = eval(dynCol)
 
                     # Get the renderer of the column and add type specific properties
                     rend = col.get_cells()[0]
                     #if str(columnTypesList[i]) == 'str':
                         # TODO: Right align text in column - add parameter to function
                         #rend.set_property('xalign', 1.0)
-                    if str(columnTypesList[i]) == 'bool':
+                    if columnTypes[i] is bool:
                         # If checkbox column, add toggle function
                         msg = "Check box found: add toggle function"
                         #print(msg)
@@ -231,6 +220,19 @@ class TreeViewHandler(GObject.GObject):
             if self.log:
                 self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
 
+    # Convert a value to the type of its list store column
+    def toColumnValue(self, value, columnType, fixedImgHeight=None):
+        if columnType is str:
+            # Make sure it's a single line
+            return str(value).strip().replace('\n', ' ').replace('\r', '')
+        if columnType is GdkPixbuf.Pixbuf:
+            if isinstance(value, GdkPixbuf.Pixbuf):
+                return value
+            return getPixbuf(str(value).strip(), fixedImgHeight)
+        if columnType is bool and isinstance(value, str):
+            return value.strip() == 'True'
+        return columnType(value)
+
     def tvchk_on_toggle(self, cell, path, liststore, colNr, *ignore):
         if path is not None:
             itr = liststore.get_iter(path)
@@ -21,103 +21,245 @@ class Tree(dict):
 
 
 class Udisks2():
-    def __init__(self):
+    def __init__(self, changed_callback=None, tasks=None):
         super(Udisks2, self).__init__()
         self.no_options = GLib.Variant('a{sv}', {})
         self.devices = Tree()
+        self.flash_only = True
+        # Called (from the GLib main loop) after the devices tree changed
+        self.changed_callback = changed_callback
+        # TaskRunner that reads the file system usage off the main loop
+        # (without one, the usage is read right away)
+        self.tasks = tasks
+        self.client = None
+        self.manager = None
+        # D-Bus object path of a block device: (drive path, device path)
+        self.object_paths = {}
+        self.notify_id = 0
+
+    # Create one long-lived client and follow the object manager signals
+    def connect_client(self):
+        if self.client is None:
+            self.client = UDisks.Client.new_sync(None)
+            self.manager = self.client.get_object_manager()
+            self.manager.connect('object-added', self.on_object_added)
+            self.manager.connect('object-removed', self.on_object_removed)
+            self.manager.connect('interface-proxy-properties-changed', self.on_properties_changed)
 
     # Create multi-dimensional dictionary with drive/device/deviceinfo
+    # Only needed once: afterwards the tree is updated from UDisks2 signals
     def fill_devices(self, flash_only=True):
-
+        self.connect_client()
+        self.flash_only = flash_only
         self.devices.clear()
-
-        client = UDisks.Client.new_sync(None)
-        manager = client.get_object_manager()
-        objects = manager.get_objects()
-
-        for o in objects:
-            block = None
-            partition = None
-            fs = None
-            drive = None
-            device_path = ''
-            fs_type = ''
-            drive_path = ''
-            add_device = False
-            removable = False
-            connectionbus = ''
-            mount_point = ''
-            total_size = 0
-            free_size = 0
-
-            block = o.get_block()
-            if block is None:
-                continue
-
-            device_path = block.get_cached_property('Device').get_bytestring().decode('utf-8')
-            fs_type = block.get_cached_property('IdType').get_string()
-            drive_path = self.get_drive_from_device_path(device_path)
-            total_size = (block.get_cached_property('Size').get_uint64() / 1024)
-
-            if not exists(drive_path) or total_size == 0:
-                continue
-
-            # Mount point
-            fs = o.get_filesystem()
-            if fs is not None:
-                mount_points = fs.get_cached_property('MountPoints').get_bytestring_array()
-                if mount_points:
-                    mount_point = mount_points[0]
-                    if exists(mount_point):
-                        total_size, free_size, used_size = self.get_mount_size(mount_point)
-
-            # There are no partitions: set free size to total size
-            partition = o.get_partition()
-            if partition is None:
-                free_size = total_size
-
-            drive_name = block.get_cached_property('Drive').get_string()
-            drive_obj = manager.get_object(drive_name)
-            if drive_obj is None:
-                continue
-            drive = drive_obj.get_drive()
-            removable = drive.get_cached_property("Removable").get_boolean()
-            connectionbus = drive.get_cached_property("ConnectionBus").get_string()
-
-            if flash_only:
-                # Check for usb mounted flash drives
-                if connectionbus == 'usb' and removable:
-                    add_device = True
-            else:
+        self.object_paths.clear()
+        for o in self.manager.get_objects():
+            self.add_object(o)
+
+    # Add the block device of a UDisks2 object to the devices tree
+    def add_object(self, o):
+        block = None
+        partition = None
+        fs = None
+        drive = None
+        device_path = ''
+        fs_type = ''
+        drive_path = ''
+        add_device = False
+        removable = False
+        connectionbus = ''
+        mount_point = ''
+        mounted = False
+        total_size = 0
+        free_size = 0
+
+        block = o.get_block()
+        if block is None:
+            return False
+
+        device_path = block.get_cached_property('Device').get_bytestring().decode('utf-8')
+        fs_type = block.get_cached_property('IdType').get_string()
+        drive_path = self.get_drive_from_device_path(device_path)
+        total_size = (block.get_cached_property('Size').get_uint64() / 1024)
+
+        if not exists(drive_path) or total_size == 0:
+            return False
+
+        # Mount point
+        fs = o.get_filesystem()
+        if fs is not None:
+            mount_points = fs.get_cached_property('MountPoints').get_bytestring_array()
+            if mount_points:
+                mount_point = mount_points[0]
+                # statvfs can block: the usage is read by request_mount_sizes
+                mounted = exists(mount_point)
+
+        # There are no partitions: set free size to total size
+        partition = o.get_partition()
+        if partition is None:
+            free_size = total_size
+
+        drive_name = block.get_cached_property('Drive').get_string()
+        drive_obj = self.manager.get_object(drive_name)
+        if drive_obj is None:
+            return False
+        drive = drive_obj.get_drive()
+        removable = drive.get_cached_property("Removable").get_boolean()
+        connectionbus = drive.get_cached_property("ConnectionBus").get_string()
+
+        if self.flash_only:
+            # Check for usb mounted flash drives
+            if connectionbus == 'usb' and removable:
                 add_device = True
-
-            if add_device:
-
-                print(('========== Device Info of: %s ==========' % device_path))
-                print(('Drive name: %s' % drive_name))
-                print(('FS Type: %s' % fs_type))
-                print(('Mount point: %s' % mount_point))
-                print(('Total size: %s' % total_size))
-                print(('Free size: %s' % free_size))
-                print(('ConnectionBus: %s' % connectionbus))
-                print(('Removable: %s' % str(removable)))
-                print(('======================================='))
-
-                if device_path == drive_path:
-                    # Drive information
-                    self.devices[drive_path]['drive_object'] = drive
-                    self.devices[drive_path]['partition_object'] = partition
-                    self.devices[drive_path]['connectionbus'] = connectionbus
-                    self.devices[drive_path]['removable'] = removable
-                    self.devices[drive_path]['total_size'] = total_size
-                    self.devices[drive_path]['free_size'] = free_size
-                else:
-                    # Partition information
-                    self.devices[drive_path][device_path]['fs_object'] = fs
-                    self.devices[drive_path][device_path]['fs_type'] = fs_type
-                    self.devices[drive_path][device_path]['mount_point'] = mount_point
-                    self.devices[drive_path][device_path]['total_size'] = total_size
-                    self.devices[drive_path][device_path]['free_size'] = free_size
+        else:
+            add_device = True
+
+        if add_device:
+            self.object_paths[o.get_object_path()] = (drive_path, device_path, drive_name)
+            if device_path == drive_path:
+                # Drive information
+                self.devices[drive_path]['drive_object'] = drive
+                self.devices[drive_path]['partition_object'] = partition
+                self.devices[drive_path]['connectionbus'] = connectionbus
+                self.devices[drive_path]['removable'] = removable
+                self.devices[drive_path]['total_size'] = total_size
+                self.devices[drive_path]['free_size'] = free_size
+            else:
+                # Partition information
+                self.devices[drive_path][device_path]['fs_object'] = fs
+                self.devices[drive_path][device_path]['fs_type'] = fs_type
+                self.devices[drive_path][device_path]['mount_point'] = mount_point
+                self.devices[drive_path][device_path]['total_size'] = total_size
+                self.devices[drive_path][device_path]['free_size'] = free_size
+                if mounted:
+                    self.request_mount_sizes(drive_path)
+        return add_device
+
+    # Remove the block device of a UDisks2 object from the devices tree
+    def remove_object_path(self, object_path):
+        paths = self.object_paths.pop(object_path, None)
+        if paths is None:
+            return False
+        drive_path, device_path = paths[0], paths[1]
+        if drive_path in self.devices:
+            drive = self.devices[drive_path]
+            if device_path == drive_path:
+                # Keep the partitions: they have their own objects
+                for key in ('drive_object', 'partition_object', 'connectionbus',
+                            'removable', 'total_size', 'free_size'):
+                    drive.pop(key, None)
+            else:
+                drive.pop(device_path, None)
+            if not drive:
+                del self.devices[drive_path]
+        return True
+
+    def on_object_added(self, manager, o):
+        if self.add_object(o):
+            self.notify_changed()
+
+    def on_object_removed(self, manager, o):
+        if self.remove_object_path(o.get_object_path()):
+            self.notify_changed()
+
+    def on_properties_changed(self, manager, o, interface, changed, invalidated):
+        object_path = o.get_object_path()
+        changed_paths = [object_path]
+        if o.get_block() is None:
+            # A drive changed: update its block devices
+            changed_paths = [p for p, paths in list(self.object_paths.items()) if paths[2] == object_path]
+        is_changed = False
+        for path in changed_paths:
+            is_changed = self.remove_object_path(path) or is_changed
+            obj = manager.get_object(path)
+            if obj is not None:
+                is_changed = self.add_object(obj) or is_changed
+        if is_changed:
+            self.notify_changed()
+
+    # Signals come in bursts: notify once when the main loop is idle
+    def notify_changed(self):
+        if self.changed_callback is not None and self.notify_id == 0:
+            self.notify_id = GLib.idle_add(self._do_notify_changed)
+
+    def _do_notify_changed(self):
+        self.notify_id = 0
+        self.changed_callback()
+        return False
+
+    # Update the free size of the mounted partitions of a drive
+    # (file system usage is not signalled by UDisks2)
+    def update_mount_sizes(self, drive_path):
+        self.set_mount_sizes(drive_path, self.read_mount_sizes(self.get_mount_points(drive_path)))
+
+    # Read the usage of the mounted partitions of a drive in a task and
+    # store it on the main loop; a newer request for the drive replaces this one
+    def request_mount_sizes(self, drive_path):
+        if self.tasks is None:
+            self.update_mount_sizes(drive_path)
+            return
+        self.tasks.run(self.read_mount_sizes, (self.get_mount_points(drive_path),),
+                       callback=lambda sizes: self.on_mount_sizes_read(drive_path, sizes),
+                       key=('mount_sizes', drive_path))
+
+    def on_mount_sizes_read(self, drive_path, sizes):
+        self.set_mount_sizes(drive_path, sizes)
+        self.notify_changed()
+
+    # The devices tree is changed by the signal handlers on the main loop.
+    # Worker threads get plain copies of what they need and hand their
+    # results back to the main loop, which stores them with the set_ functions.
+
+    # Return {device path: mount point} of the mounted partitions of a drive
+    def get_mount_points(self, drive_path):
+        mount_points = {}
+        if drive_path in self.devices:
+            for device_path in self.get_drive_device_paths(drive_path):
+                mount_point = self.devices[drive_path][device_path].get('mount_point', '')
+                if mount_point:
+                    mount_points[device_path] = mount_point
+        return mount_points
+
+    # Return {device path: (total, free)} of the mount points (any thread)
+    def read_mount_sizes(self, mount_points):
+        sizes = {}
+        for device_path, mount_point in list(mount_points.items()):
+            if exists(mount_point):
+                total, free, used = self.get_mount_size(mount_point)
+                sizes[device_path] = (total, free)
+        return sizes
+
+    # Store the sizes returned by read_mount_sizes
+    def set_mount_sizes(self, drive_path, sizes):
+        if drive_path not in self.devices:
+            return
+        drive = self.devices[drive_path]
+        for device_path, (total, free) in list(sizes.items()):
+            if device_path in drive:
+                drive[device_path]['total_size'] = total
+                drive[device_path]['free_size'] = free
+
+    # Store the mount point of a device mounted with mount_filesystem
+    def set_mount_point(self, device_path, mount_point):
+        drive_path = self.get_drive_from_device_path(device_path)
+        if drive_path in self.devices and device_path in self.devices[drive_path]:
+            self.devices[drive_path][device_path]['mount_point'] = mount_point
+
+    # Return a plain copy of the information of a partition (None when it is gone)
+    def get_device_info(self, drive_path, device_path):
+        if drive_path in self.devices and device_path in self.devices[drive_path]:
+            return dict(self.devices[drive_path][device_path])
+        return None
+
+    # Return the file system objects of the partitions of a drive
+    def get_filesystems(self, drive_path):
+        filesystems = []
+        if drive_path in self.devices:
+            for device_path in self.get_drive_device_paths(drive_path):
+                fs = self.devices[drive_path][device_path].get('fs_object')
+                if fs is not None:
+                    filesystems.append(fs)
+        return filesystems
 
     def get_drives(self):
         drives = []
@@ -150,7 +292,8 @@ class Udisks2():
 
     # Adapted from udisk's test harness.
     # This is why the entire backend needs to be its own thread.
-    def _mount_filesystem(self, fs):
+    # Mount a file system object; returns the mount point (any thread)
+    def mount_filesystem(self, fs):
         mount_points = []
         if fs is not None:
             '''Try to mount until it does not fail with "Busy".'''
@@ -177,7 +320,7 @@ class Udisks2():
     def mount_device(self, device_path):
         drive = self.get_drive_from_device_path(device_path)
         fs = self.devices[drive][device_path]['fs_object']
-        mount = self._mount_filesystem(fs)
+        mount = self.mount_filesystem(fs)
         if mount != '':
             # Set mount point and free space for this device
             total, free, used = self.get_mount_size(mount)
@@ -185,7 +328,8 @@ class Udisks2():
             self.devices[drive][device_path]['free_size'] = free
         return mount
 
-    def _unmount_filesystem(self, fs):
+    # Unmount a file system object (any thread)
+    def unmount_filesystem(self, fs):
         try:
             return fs.call_unmount_sync(self.no_options, None)
         except:
@@ -194,12 +338,12 @@ class Udisks2():
     def unmount_device(self, device_path):
         drive = self.get_drive_from_device_path(device_path)
         fs = self.devices[drive][device_path]['fs_object']
-        return self._unmount_filesystem(fs)
+        return self.unmount_filesystem(fs)
 
     def unmount_drive(self, drive_path):
         for device_path in self.get_drive_device_paths(drive_path):
             fs = self.devices[drive_path][device_path]['fs_object']
-            self._unmount_filesystem(fs)
+            self.unmount_filesystem(fs)
 
     def poweroff_drive(self, drive_path):
         try:
@@ -6,11 +6,10 @@ import gi
 gi.require_version('Gtk', '3.0')
 
 # from gi.repository import Gtk, GdkPixbuf, GObject, Pango, Gdk, GLib
-from gi.repository import Gtk, GObject
+from gi.repository import Gtk, GLib
 from os.path import join, abspath, dirname, basename, \
                     splitext, exists, expanduser, isdir
-from utils import ExecuteThreadedCommands, getoutput, \
-                  shell_exec, getPackageVersion
+from utils import shell_exec
 import os
 from glob import glob
 from datetime import datetime
@@ -18,9 +17,13 @@ from dialogs import MessageDialog, ErrorDialog, WarningDialog, \
                     SelectFileDialog, QuestionDialog
 from combobox import ComboBoxHandler
 from treeview import TreeViewHandler
-from queue import Queue
+from tasks import TaskRunner
+from isoscanner import IsoScanner
 from logger import Logger
 from udisks2 import Udisks2
+from progress import ProgressReader, PROGRESS_FD_ENV
+from constants import LOG_FILE, LOG_MAX_SIZE_KB, ISO_ENTRY_DELAY, get_version
+from startup import StartupProfiler
 
 # i18n: http://docs.python.org/3/library/gettext.html
 import gettext
@@ -31,7 +34,9 @@ gettext.textdomain('usb-creator')
 #class for the main window
 class USBCreator(object):
 
-    def __init__(self):
+    def __init__(self, profiler=None):
+        # Times the start up phases (--profile-startup)
+        self.profiler = profiler or StartupProfiler()
 
         # Load window and widgets
         self.scriptName = basename(__file__)
@@ -62,6 +67,7 @@ class USBCreator(object):
         self.btnDelete = go("btnDelete")
         self.pbUsbCreator = go("pbUsbCreator")
         self.statusbar = go("statusbar")
+        self.profiler.mark('load window')
 
         # Translations
         self.window.set_title(_("USB Creator"))
@@ -69,6 +75,7 @@ class USBCreator(object):
         self.lblUsb.set_label(_("USB"))
         self.available_text = _("Available")
         self.required_text = _("Required")
+        self.all_devices_text = _("All USB devices")
         self.chkFormatDevice.set_label(_("Format device"))
         self.chkFormatDevice.set_tooltip_text(_("Warning: all data will be lost"))
         self.chkRepairDevice.set_label(_("Repair device"))
@@ -81,14 +88,16 @@ class USBCreator(object):
         self.btnBrowseIso.set_tooltip_text(_("Browse for ISO file"))
         self.btnClear.set_tooltip_text(_("Clear the ISO field"))
 
-        # Log lines to show: check string, percent done (0=pulse, appends last word in log line), show line (translatable)
-        self.log_lines = []
-        self.log_lines.append(["partitioning usb", 5, _("Partitioning USB...")])
-        self.log_lines.append(["searching for bad blocks", 0, _("Searching for bad block")])
-        self.log_lines.append(["installing", 15, _("Installing Grub...")])
-        self.log_lines.append(["rsync", 25, _("Start copying ISO...")])
-        self.log_lines.append(["left to copy", 0, _("kB left to copy:")])
-        self.log_lines.append(["check hash", 85, _("Check hash of ISO...")])
+        # Progress phases reported by usb-creator (see progress.py) and the text to show
+        self.phase_texts = {}
+        self.phase_texts['partition'] = _("Partitioning USB...")
+        self.phase_texts['format'] = _("Formatting USB...")
+        self.phase_texts['badblocks'] = _("Searching for bad block")
+        self.phase_texts['bootloader'] = _("Installing Grub...")
+        self.phase_texts['copy'] = _("Start copying ISO...")
+        self.phase_texts['write'] = _("Writing ISO to USB...")
+        self.phase_texts['grub'] = _("Configuring Grub...")
+        self.phase_texts['verify'] = _("Check hash of ISO...")
 
         # Initiate variables
         self.device = {}
@@ -98,46 +107,76 @@ class USBCreator(object):
         self.device['available'] = 0
         self.device["new_iso"] = ''
         self.device["new_iso_required"] = 0
-        self.logos = self.get_logos()
-        self.queue = Queue(-1)
-        self.threads = {}
+        # Loaded after the window is shown
+        self.logos = {}
+        # Blocking work runs in worker threads, results come back on the main loop
+        self.tasks = TaskRunner()
+        self.command_running = False
+        # Cached ISO listings of the ISO directory and the USB
+        self.scanner = IsoScanner()
+        # The ISO path is evaluated when typing paused for iso_entry_delay ms
+        self.iso_entry_delay = ISO_ENTRY_DELAY
+        self.iso_entry_timeout = 0
+        self.progress_fd = None
+        self.filling_devices = False
         self.htmlDir = join(self.mediaDir, "html")
         self.helpFile = join(self.get_language_dir(), "help.html")
-        log = getoutput("cat /usr/bin/usb-creator | grep 'LOG=' | cut -d'=' -f 2")
-        self.log_file = log[0]
-        self.log = Logger(self.log_file, addLogTime=False, maxSizeKB=5120)
+        self.log_file = LOG_FILE
+        # Log records are written by a background thread
+        self.log = Logger(self.log_file, addLogTime=False, maxSizeKB=LOG_MAX_SIZE_KB, queued=True)
         self.tvUsbIsosHandler = TreeViewHandler(self.tvUsbIsos)
-        self.udisks2 = Udisks2()
+        self.udisks2 = Udisks2(changed_callback=self.on_devices_changed, tasks=self.tasks)
 
         self.lblAvailable.set_label('')
         self.lblRequired.set_label('')
 
+        self.version_text = _("Version")
+        self.pck_version = ''
+        self.profiler.mark('initialize')
+
         # Connect builder signals and show window
         self.builder.connect_signals(self)
         self.window.show_all()
-
-        # Get attached devices
-        self.on_btnRefresh_clicked()
+        self.profiler.mark('show window')
 
         # Init log
         init_log = ">>> Start USB Creator: {} <<<".format(datetime.now())
         self.log.write(init_log)
 
+        # Everything else waits until the first frame is drawn
+        # (redrawing has a higher priority than PRIORITY_LOW)
+        GLib.idle_add(self.on_window_drawn, priority=GLib.PRIORITY_LOW)
+
+    def on_window_drawn(self):
+        self.profiler.mark('first frame')
+        self.logos = self.get_logos()
+        self.profiler.mark('load logos')
+        # Get attached devices
+        self.on_btnRefresh_clicked()
+        self.profiler.mark('enumerate devices')
         # Version information
-        self.version_text = _("Version")
-        self.pck_version = getPackageVersion('usb-creator')
+        self.tasks.run(get_version, callback=self.on_version_read)
+        return False
+
+    def on_version_read(self, version):
+        self.pck_version = version
         self.set_statusbar_message("{}: {}".format(self.version_text, self.pck_version))
+        self.profiler.mark('read version')
+        self.profiler.report()
 
     # ===============================================
     # Main window functions
     # ===============================================
 
     def on_btnExecute_clicked(self, widget):
-        if exists(self.device["path"]):
+        if self.device_exists():
             arguments = []
             arguments.append("-d {}".format(self.device["path"]))
             clear = self.chkFormatDevice.get_active()
             repair = self.chkRepairDevice.get_active()
+            # Do not wait for an evaluation of the ISO path that is pending
+            if self.iso_entry_timeout or self.tasks.is_pending('iso'):
+                self.evaluate_txtIso_now()
             iso = self.device["new_iso"]
             iso_path = self.txtIso.get_text().strip()
 
@@ -181,14 +220,31 @@ class USBCreator(object):
             msg =  _("Are you sure you want to remove the selected ISO from the device?")
             answer = QuestionDialog(self.btnDelete.get_label(), msg)
             if answer:
-                for iso in selected_isos:
-                    iso_path = join(self.device["mount"], iso)
-                    if exists(iso_path):
-                        os.remove(iso_path)
-                        self.log.write("Remove ISO: {}".format(iso_path))
-                shell_exec("usb-creator -d {} -g".format(self.device["path"]))
-                self.on_btnRefresh_clicked()
-                self.fill_treeview_usbcreator(self.device["mount"])
+                iso_paths = [join(self.device["mount"], iso) for iso in selected_isos]
+                device_path = self.device["path"]
+                self.set_buttons_state(False)
+                self.tasks.run(self.delete_isos, (iso_paths, device_path, self.udisks2.get_mount_points(device_path)),
+                               callback=self.on_isos_deleted, error_callback=self.on_task_error)
+
+    def delete_isos(self, iso_paths, device_path, mount_points):
+        # Runs in a worker thread: the devices tree is only changed on the main loop
+        removed = []
+        for iso_path in iso_paths:
+            if exists(iso_path):
+                os.remove(iso_path)
+                removed.append(iso_path)
+        shell_exec("usb-creator -d {} -g".format(device_path))
+        for iso_path in iso_paths:
+            self.scanner.invalidate(dirname(iso_path))
+        return {'removed': removed, 'path': device_path,
+                'sizes': self.udisks2.read_mount_sizes(mount_points)}
+
+    def on_isos_deleted(self, result):
+        for iso_path in result['removed']:
+            self.log.write("Remove ISO: {}".format(iso_path))
+        self.udisks2.set_mount_sizes(result['path'], result['sizes'])
+        self.set_buttons_state(True)
+        self.fill_device_combo()
 
     def on_btnBrowseIso_clicked(self, widget):
         file_filter = Gtk.FileFilter()
@@ -209,98 +265,151 @@ class USBCreator(object):
         self.txtIso.set_text('')
 
     def on_txtIso_changed(self, widget=None):
-        iso_path = self.txtIso.get_text().strip()
-        if exists(iso_path):
-            if isdir(iso_path):
-                isos = glob(join(iso_path, '*.iso'))
-                if isos:
-                    required = 0
-                    for iso in isos:
-                        # Check if these ISOs overwrite current USB ISOs
-                        check_usb_iso_size = 0
-                        if not self.chkFormatDevice.get_active():
-                            check_usb_iso = join(self.device["mount"], basename(iso))
-                            if exists(check_usb_iso):
-                                check_usb_iso_size = self.get_iso_size(check_usb_iso)
-                        required += (self.get_iso_size(iso) - check_usb_iso_size)
-                    if required < 0:
-                        required = 0
-                    self.lblRequired.set_label("{}: {} MB".format(self.required_text, int(required / 1024)))
-                    # Save the info
-                    self.device["new_iso"] = iso_path
-                    self.device["new_iso_required"] = required
-                    self.log.write("New ISO directory: {}, {}".format(iso_path, required))
-                else:
-                    self.device["new_iso"] = ''
-                    self.device["new_iso_required"] = 0
-                    self.log.write("New ISO directory does not contain ISOs: {}".format(iso_path))
-            else:
-                # Check if this ISO overwrites current USB ISO
-                check_usb_iso_size = 0
-                if not self.chkFormatDevice.get_active():
-                    check_usb_iso = join(self.device["mount"], basename(iso_path))
-                    if exists(check_usb_iso):
-                        check_usb_iso_size = self.get_iso_size(check_usb_iso)
-                required = (self.get_iso_size(iso_path) - check_usb_iso_size)
-                self.lblRequired.set_label("{}: {} MB".format(self.required_text, int(required / 1024)))
-                # Save the info
-                self.device["new_iso"] = iso_path
-                self.device["new_iso_required"] = required
-                self.log.write("New ISO: {}, {}".format(iso_path, required))
+        # Drop the evaluation of the previous text
+        self.tasks.cancel('iso')
+        if self.iso_entry_timeout:
+            GLib.source_remove(self.iso_entry_timeout)
+            self.iso_entry_timeout = 0
+        if widget is not None and self.iso_entry_delay > 0:
+            # Typed or pasted: wait until typing pauses
+            self.iso_entry_timeout = GLib.timeout_add(self.iso_entry_delay, self.on_iso_entry_timeout)
         else:
-            self.device["new_iso"] = ''
-            self.device["new_iso_required"] = 0
+            self.evaluate_txtIso()
+
+    def on_iso_entry_timeout(self):
+        self.iso_entry_timeout = 0
+        self.evaluate_txtIso()
+        return False
+
+    def get_txtIso_arguments(self):
+        iso_path = self.txtIso.get_text().strip()
+        mount = self.device["mount"]
+        if self.chkFormatDevice.get_active():
+            # The ISOs on the USB will be removed
+            mount = ''
+        return (iso_path, mount)
+
+    def evaluate_txtIso(self):
+        # Only the result of the latest evaluation is used
+        self.tasks.run(self.evaluate_iso_path, self.get_txtIso_arguments(),
+                       callback=self.on_iso_path_evaluated, key='iso')
+
+    def evaluate_txtIso_now(self):
+        if self.iso_entry_timeout:
+            GLib.source_remove(self.iso_entry_timeout)
+            self.iso_entry_timeout = 0
+        self.tasks.cancel('iso')
+        self.on_iso_path_evaluated(self.evaluate_iso_path(*self.get_txtIso_arguments()))
+
+    def evaluate_iso_path(self, iso_path, mount):
+        # Runs in a worker thread
+        # Returns (ISO path or '', required kB or None, log message)
+        iso, required = self.scanner.get_required(iso_path, mount)
+        if required is None:
+            return ('', None, None)
+        if iso == '':
+            return ('', 0, "New ISO directory does not contain ISOs: {}".format(iso_path))
+        if isdir(iso_path):
+            return (iso, required, "New ISO directory: {}, {}".format(iso_path, required))
+        return (iso, required, "New ISO: {}, {}".format(iso_path, required))
+
+    def on_iso_path_evaluated(self, result):
+        iso_path, required, message = result
+        # Save the info
+        self.device["new_iso"] = iso_path
+        self.device["new_iso_required"] = required or 0
+        if required is None:
             self.lblRequired.set_text('')
+        elif iso_path:
+            self.lblRequired.set_label("{}: {} MB".format(self.required_text, int(required / 1024)))
+        if message is not None:
+            self.log.write(message)
 
     def on_btnRefresh_clicked(self, widget=None):
+        # Full rescan: afterwards the device list follows UDisks2 signals
         self.udisks2.fill_devices()
+        self.fill_device_combo()
+
+    def on_devices_changed(self):
+        # Do not touch the devices while usb-creator is running:
+        # the device list is refreshed when it is done
+        if self.command_running:
+            return
+        entries = self.get_device_entries()
+        model = self.cmbDevice.get_model()
+        listed = [row[0] for row in model] if model is not None else []
+        if sorted(entries) != sorted(listed):
+            self.log.write("Device list changed: {}", 'on_devices_changed', msgArgs=(entries,))
+            self.fill_device_combo()
+
+    def get_device_entries(self):
+        # With more than one drive, all drives can be written at once
         drives = self.udisks2.get_drives()
-        self.cmbDeviceHandler.fillComboBox(drives, 0)
+        if len(drives) > 1:
+            drives.append(self.all_devices_text)
+        return drives
+
+    def device_exists(self):
+        paths = [p for p in self.device["path"].split(',') if p != '']
+        return len(paths) > 0 and all(exists(p) for p in paths)
+
+    def fill_device_combo(self):
+        # Keep the selected drive when it is still there
+        drives = self.get_device_entries()
+        selected = self.cmbDeviceHandler.getValue()
+        if selected not in drives:
+            selected = 0
+        # Handle the combo box change once, not for the intermediate states
+        self.filling_devices = True
+        self.cmbDeviceHandler.fillComboBox(drives, selected)
+        self.filling_devices = False
+        self.on_cmbDevice_changed()
 
     def on_btnUnmount_clicked(self, widget):
+        self.set_buttons_state(False)
+        # In batch mode the path holds comma separated drives
+        filesystems = []
+        for drive_path in self.device["path"].split(','):
+            filesystems += self.udisks2.get_filesystems(drive_path)
+        self.tasks.run(self.unmount_drives, (filesystems,),
+                       callback=self.on_drives_unmounted, error_callback=self.on_drives_unmounted)
+
+    def unmount_drives(self, filesystems):
+        # Runs in a worker thread
+        for fs in filesystems:
+            self.udisks2.unmount_filesystem(fs)
+
+    def on_drives_unmounted(self, error=None):
         unmount_text = _("Unmount")
-        device = self.device["path"]
-        try:
-            self.udisks2.unmount_drive(device)
-            self.on_btnRefresh_clicked()
+        self.set_buttons_state(True)
+        if error is None:
+            self.fill_device_combo()
             msg = _("You can now safely remove the device.")
-        except Exception as e:
+        else:
             msg = _("Could not unmount the device.\n"
                     "Please unmount the device manually.")
-            self.log.write("ERROR: %s" % str(e))
+            self.log.write("ERROR: %s" % str(error))
         MessageDialog(unmount_text, msg)
 
     def on_cmbDevice_changed(self, widget=None):
+        if self.filling_devices:
+            return
         drive_path = self.cmbDeviceHandler.getValue()
         device_paths = []
-        if drive_path is not None:
+        if drive_path == self.all_devices_text:
+            self.select_all_devices()
+        elif drive_path is not None:
             drive = self.udisks2.devices[drive_path]
             device_paths = self.udisks2.get_drive_device_paths(drive_path)
             device = ''
             if device_paths:
                 device = device_paths[0]
-            mount = ''
-            size = 0
-            available = 0
 
             # Get free size on USB
             size = drive['total_size']
             available = drive['free_size']
-            if self.chkFormatDevice.get_active():
-                available = size
 
             if device != '':
-                mount = drive[device]['mount_point']
-                if not exists(mount):
-                    # Mount if not already mounted
-                    try:
-                        mount = self.udisks2.mount_device(device)
-                    except Exception as e:
-                        self.show_message(6)
-                        self.log.write("ERROR: %s" % str(e))
-                if exists(mount) and not self.chkFormatDevice.get_active():
-                    size = drive[device]['total_size']
-                    available = drive[device]['free_size']
                 # This function can be called from on_chkFormatDevice_toggled
                 if widget != self.chkFormatDevice:
                     self.chkFormatDevice.set_sensitive(True)
@@ -309,23 +418,16 @@ class USBCreator(object):
                 # No partition: always format the device
                 self.chkFormatDevice.set_active(True)
                 self.chkFormatDevice.set_sensitive(False)
-
             self.chkRepairDevice.set_active(False)
-            self.fill_treeview_usbcreator(mount)
-            self.lblAvailable.set_label("{}: {} MB".format(self.available_text, int(available / 1024)))
 
-            # Save the info
-            self.device['path'] = drive_path
-            self.device['mount'] = mount
-            self.device['size'] = size
-            self.device['available'] = available
-            self.log.write("Selected device info: {}".format(self.device))
-
-            # Update info
-            iso_path = self.txtIso.get_text().strip()
-            if iso_path != "" and exists(iso_path):
-                self.on_txtIso_changed()
+            # Mounting and listing the ISOs on the USB is done in a worker thread
+            # with a copy of the partition info: the devices tree changes on the main loop
+            partition = self.udisks2.get_device_info(drive_path, device) if device else None
+            self.tasks.run(self.load_device,
+                           (drive_path, device, partition, size, available, self.chkFormatDevice.get_active()),
+                           callback=self.on_device_loaded, key='device')
         else:
+            self.tasks.cancel('device')
             self.fill_treeview_usbcreator()
             self.lblAvailable.set_label('')
             self.lblRequired.set_label('')
@@ -337,6 +439,72 @@ class USBCreator(object):
             self.device["new_iso"] = ''
             self.device["new_iso_required"] = 0
 
+    def load_device(self, drive_path, device, partition, size, available, format_device):
+        # Runs in a worker thread: mount the USB and list its ISOs
+        info = {'path': drive_path, 'device': device, 'mount': '', 'size': size,
+                'available': available, 'sizes': {}, 'isos': [], 'error': None}
+        if partition is not None:
+            mount = partition['mount_point']
+            if not exists(mount):
+                # Mount if not already mounted
+                try:
+                    mount = self.udisks2.mount_filesystem(partition['fs_object'])
+                except Exception as e:
+                    info['error'] = e
+            if exists(mount):
+                info['sizes'] = self.udisks2.read_mount_sizes({device: mount})
+                if device in info['sizes'] and not format_device:
+                    info['size'], info['available'] = info['sizes'][device]
+            info['mount'] = mount
+            # Another stick can be mounted on the same path: always read the USB again
+            self.scanner.invalidate(mount)
+            info['isos'] = self.get_usb_isos(mount)
+        if format_device:
+            info['available'] = info['size']
+        return info
+
+    def on_device_loaded(self, info):
+        if info['mount']:
+            self.udisks2.set_mount_point(info['device'], info['mount'])
+            self.udisks2.set_mount_sizes(info['path'], info['sizes'])
+        if info['error'] is not None:
+            self.show_message(6)
+            self.log.write("ERROR: %s" % str(info['error']))
+        self.fill_treeview_usbcreator(info['mount'], info['isos'])
+        self.lblAvailable.set_label("{}: {} MB".format(self.available_text, int(info['available'] / 1024)))
+
+        # Save the info
+        self.device['path'] = info['path']
+        self.device['mount'] = info['mount']
+        self.device['size'] = info['size']
+        self.device['available'] = info['available']
+        self.log.write("Selected device info: {}", msgArgs=(self.device,))
+
+        # Update info
+        if self.txtIso.get_text().strip() != "":
+            self.on_txtIso_changed()
+
+    def select_all_devices(self):
+        # Batch mode: the devices are always formatted
+        # and the smallest device determines the available space
+        drives = self.udisks2.get_drives()
+        available = min([self.udisks2.devices[d]['total_size'] for d in drives])
+        self.chkFormatDevice.set_active(True)
+        self.chkFormatDevice.set_sensitive(False)
+        self.chkRepairDevice.set_active(False)
+        self.fill_treeview_usbcreator()
+        self.lblAvailable.set_label("{}: {} MB".format(self.available_text, int(available / 1024)))
+
+        # Save the info
+        self.device['path'] = ','.join(drives)
+        self.device['mount'] = ''
+        self.device['size'] = available
+        self.device['available'] = available
+        self.log.write("Selected devices info: {}", msgArgs=(self.device,))
+
+        if self.txtIso.get_text().strip() != "":
+            self.on_txtIso_changed()
+
     def on_chkFormatDevice_toggled(self, widget):
         # Recalculate available space and requied space
         self.on_cmbDevice_changed(widget)
@@ -345,69 +513,79 @@ class USBCreator(object):
         # Open the help file as the real user (not root)
         shell_exec("%s/open-as-user \"%s\"" % (self.scriptDir, self.helpFile))
 
-    def fill_treeview_usbcreator(self, mount=''):
+    def get_usb_isos(self, mount):
+        # Returns (name, size in kB) of the ISOs on the USB
+        if not mount:
+            return []
+        return self.scanner.get_isos(mount)
+
+    def fill_treeview_usbcreator(self, mount='', isos=()):
         isos_list = []
         # columns: checkbox, image (logo), device, driver
         column_types = ['bool', 'GdkPixbuf.Pixbuf', 'str', 'str']
 
-        if exists(mount):
-            isos = glob(join(mount, '*.iso'))
-            for iso in isos:
-                iso_name = basename(iso)
-                iso_name_lower = iso_name.lower()
-                iso_size = "{} MB".format(int(self.get_iso_size(iso) / 1024))
-                iso_logo = ""
-                for key, logo in list(self.logos.items()):
-                    if key != "iso":
-                        if key in iso_name_lower:
-                            if len(logo) > len(iso_logo):
-                                iso_logo = logo
-                if iso_logo == "":
-                    iso_logo = self.logos["iso"]
-                self.log.write("ISO on {}: {}, {}, {}".format(mount, iso_name, iso_size, iso_logo))
-                isos_list.append([False, iso_logo, iso_name, iso_size])
+        for iso_name, iso_size in isos:
+            iso_name_lower = iso_name.lower()
+            iso_size = "{} MB".format(int(iso_size / 1024))
+            iso_logo = ""
+            for key, logo in list(self.logos.items()):
+                if key != "iso":
+                    if key in iso_name_lower:
+                        if len(logo) > len(iso_logo):
+                            iso_logo = logo
+            if iso_logo == "":
+                iso_logo = self.logos.get("iso", "")
+            self.log.write("ISO on {}: {}, {}, {}", msgArgs=(mount, iso_name, iso_size, iso_logo))
+            isos_list.append([False, iso_logo, iso_name, iso_size])
 
         # Fill treeview
         self.tvUsbIsosHandler.fillTreeview(contentList=isos_list, columnTypesList=column_types)
 
     def exec_command(self, command):
         try:
-            # Run the command in a separate thread
+            # Run the command in a worker thread
             self.set_buttons_state(False)
-            name = 'cmd'
-            t = ExecuteThreadedCommands([command], self.queue)
-            self.threads[name] = t
-            t.daemon = True
-            t.start()
-            self.queue.join()
-            GObject.timeout_add(1000, self.check_thread, name)
-
+            self.command_running = True
+            # usb-creator writes its progress records to a pipe
+            read_fd, self.progress_fd = os.pipe()
+            os.set_inheritable(self.progress_fd, True)
+            env = dict(os.environ)
+            env[PROGRESS_FD_ENV] = str(self.progress_fd)
+            ProgressReader(read_fd, self.on_progress).start()
+            self.tasks.run(shell_exec, (command, {'env': env, 'pass_fds': (self.progress_fd,)}),
+                           callback=self.on_command_done, error_callback=self.on_command_done)
         except Exception as detail:
+            self.command_running = False
+            self.set_buttons_state(True)
             ErrorDialog(self.btnExecute.get_label(), detail)
 
-    def check_thread(self, name):
-        if self.threads[name].is_alive():
-            self.set_progress()
-            if not self.queue.empty():
-                ret = self.queue.get()
-                self.log.write("Queue returns: {}".format(ret), 'check_thread')
-                self.queue.task_done()
-                self.show_message(ret)
-            return True
-
-        # Thread is done
-        self.log.write(">> Thread is done", 'check_thread')
-        ret = 0
-        if not self.queue.empty():
-            ret = self.queue.get()
-            self.queue.task_done()
-        del self.threads[name]
+    def on_command_done(self, ret):
+        # Called on the main loop as soon as usb-creator returns
+        self.log.write(">> Command is done: {}".format(ret), 'on_command_done')
+        self.command_running = False
+        # The progress reader stops when all writers closed the pipe
+        if self.progress_fd is not None:
+            os.close(self.progress_fd)
+            self.progress_fd = None
         self.set_buttons_state(True)
-        self.on_btnRefresh_clicked()
-        self.fill_treeview_usbcreator(self.device["mount"])
         self.set_statusbar_message("{}: {}".format(self.version_text, self.pck_version))
+        # The ISOs on the USB changed
+        if self.device["mount"]:
+            self.scanner.invalidate(self.device["mount"])
+        # Refresh the free space (statvfs) of the USB, then the device list
+        drive_path = self.device["path"]
+        self.tasks.run(self.udisks2.read_mount_sizes, (self.udisks2.get_mount_points(drive_path),),
+                       callback=lambda sizes: self.on_mount_sizes_read(drive_path, sizes))
         self.show_message(ret)
-        return False
+
+    def on_mount_sizes_read(self, drive_path, sizes):
+        self.udisks2.set_mount_sizes(drive_path, sizes)
+        self.fill_device_combo()
+
+    def on_task_error(self, error):
+        self.log.write("ERROR: %s" % str(error))
+        self.set_buttons_state(True)
+        ErrorDialog(self.window.get_title(), str(error))
 
     def set_buttons_state(self, enable):
         if not enable:
@@ -445,44 +623,32 @@ class USBCreator(object):
             logos_dict[key] = logo
         return logos_dict
 
-    def set_progress(self):
-        if exists(self.log_file):
-            msg = ''
-            last_line = getoutput("tail -50 {} | grep -v DEBUG | grep -v ==".format(self.log_file))
-            for line in reversed(last_line):
-                # Check for session start line: that is the last line to check
-                if ">>>>>" in line and "<<<<<" in line:
-                    break
-                for chk_line in self.log_lines:
-                    if chk_line[0] in line.lower():
-                        #print((line))
-                        word = ''
-                        if chk_line[1] == 0:
-                            self.pbUsbCreator.pulse()
-                            words = line.split(' ')
-                            for word in reversed(words):
-                                if word.strip() != '':
-                                    break
-                        else:
-                            self.pbUsbCreator.set_fraction(float(chk_line[1] / 100))
-                        msg = "{} {}".format(chk_line[2], word)
-                        break
-                if msg != '':
-                    break
-            self.set_statusbar_message(msg)
+    def on_progress(self, record):
+        # Show a progress record of usb-creator
+        if self.progress_fd is None:
+            return
+        msg = self.phase_texts.get(record['phase'], '')
+        if record.get('device'):
+            msg = "{}: {}".format(basename(record['device']), msg)
+        total = record.get('bytes_total') or 0
+        if total > 0:
+            # Copy records tell how much is already written to the device
+            done = record.get('bytes_durable', record.get('bytes_done')) or 0
+            self.pbUsbCreator.set_fraction(min(1.0, float(done) / total))
+            msg = "{} {} / {} MB".format(msg, int(done / 1048576), int(total / 1048576))
+            rate = record.get('rate') or 0
+            eta = record.get('eta')
+            if rate > 0 and eta is not None:
+                msg = "{} ({:.1f} MB/s, {}:{:02d})".format(msg, rate / 1048576, int(eta / 60), int(eta % 60))
+        else:
+            self.pbUsbCreator.pulse()
+        self.set_statusbar_message(msg)
 
     def set_statusbar_message(self, message):
         if message is not None:
             context = self.statusbar.get_context_id('message')
             self.statusbar.push(context, message)
 
-    def get_iso_size(self, iso):
-        # Returns kilobytes
-        iso_info = os.stat(iso)
-        if iso_info:
-            return int(iso_info.st_size / 1024)
-        return 0
-
     # Close the gui
     def on_usbcreator_destroy(self, widget):
         # Unmount devices of drive and power-off drive
@@ -493,6 +659,8 @@ class USBCreator(object):
                 self.udisks2.poweroff_drive(self.device['path'])
         except Exception as e:
             self.log.write("ERROR: %s" % str(e))
+        self.tasks.shutdown()
+        self.log.close()
         # Close the app
         Gtk.main_quit()
 
@@ -524,6 +692,11 @@ class USBCreator(object):
                 elif ret == 11:
                     ErrorDialog(self.btnExecute.get_label(), _("Unable to guess distribution from ISO name.\n"
                                                                "Make sure you have the distribution name in the ISO name."))
+                elif ret == 12:
+                    ErrorDialog(self.btnExecute.get_label(), _("Copying the ISO to the device failed."))
+                elif ret == 13:
+                    ErrorDialog(self.btnExecute.get_label(), _("Unable to download the initrd of an ISO.\n"
+                                                               "The ISO has no Grub menu entry."))
                 else:
                     msg = _("An unknown error accured.\n"
                             "Please, visit our forum for support: http://forums.solydxk.com")
@@ -14,9 +14,10 @@ def shell_exec_popen(command, kwargs={}):
                             stdout=subprocess.PIPE, **kwargs)
 
 
-def shell_exec(command):
+def shell_exec(command, kwargs=None):
+    kwargs = kwargs or {}
     print(('Executing:', command))
-    return subprocess.call(command, shell=True)
+    return subprocess.call(command, shell=True, **kwargs)
 
 
 def getoutput(command):
@@ -144,6 +145,15 @@ def getPackageVersion(package, candidate=False):
     return version
 
 
+# Return the path of a partition of a device
+# Loop, nvme and mmc devices end in a digit and put a p before the number
+# (the same rule as PARTDEV in usr/bin/usb-creator)
+def get_partition_path(device, number=1):
+    if device[-1:].isdigit():
+        return "{}p{}".format(device, number)
+    return "{}{}".format(device, number)
+
+
 # Class to run commands in a thread and return the output in a queue
 class ExecuteThreadedCommands(threading.Thread):
 
@@ -0,0 +1,152 @@
+#! /usr/bin/env python3
+
+# Verify ISOs on the USB against their source ISOs.
+# Source ISOs are hashed in parallel in a process pool (they usually live on
+# a fast disk), while the copies on the USB are read with a separate, small
+# concurrency limit so that flash media is not thrashed by parallel reads.
+# Results are reported as soon as both digests of an ISO are known.
+#
+# Command line usage (used by the usb-creator backend):
+# verifier.py [--cache FILE] [--workers N] [--target-concurrency N]
+#             --target-dir /mount/point "/path/to/your.iso" [...]
+
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from os.path import join, basename
+from copyengine import sha256_file, EXIT_MISMATCH
+from digestcache import DigestCache
+from progress import ProgressWriter
+
+
+class Verifier():
+    def __init__(self, cache_path=None, source_workers=None, target_concurrency=1,
+                 direct=True, result_callback=None):
+        self.cache = DigestCache(cache_path) if cache_path else None
+        self.source_workers = source_workers or os.cpu_count() or 1
+        self.target_concurrency = max(1, target_concurrency)
+        self.direct = direct
+        self.result_callback = result_callback
+
+    # Verify a list of (source, target) tuples
+    # Returns a list of result dictionaries in order of completion
+    def verify(self, pairs):
+        results = []
+        pending = {}
+        digests = {}
+        # Read errors per pair: one unreadable ISO must not stop the others
+        errors = {}
+        for source, target in pairs:
+            digests[(source, target)] = {'source': None, 'target': None}
+            errors[(source, target)] = None
+
+        with ProcessPoolExecutor(max_workers=self.source_workers) as source_pool, \
+             ThreadPoolExecutor(max_workers=self.target_concurrency) as target_pool:
+            for source, target in pairs:
+                pair = (source, target)
+                # The copy on the USB is always read, the source only when not cached
+                future = target_pool.submit(sha256_file, target, self.direct)
+                pending[future] = (pair, 'target')
+                try:
+                    digest = self.cache.get(source) if self.cache else None
+                    if digest is None:
+                        key = self.cache.get_key(source) if self.cache else None
+                        future = source_pool.submit(sha256_file, source)
+                        pending[future] = (pair, 'source', key)
+                    else:
+                        digests[pair]['source'] = digest
+                except OSError as e:
+                    # Deleted or unreadable source
+                    digests[pair]['source'] = ''
+                    errors[pair] = "Cannot read {}: {}".format(source, e)
+
+            for future in as_completed(pending):
+                info = pending[future]
+                pair, side = info[0], info[1]
+                try:
+                    digest = future.result()
+                except Exception as e:
+                    # OSError from reading the file or a failed worker process
+                    digest = ''
+                    errors[pair] = "Cannot read {}: {}".format(pair[0] if side == 'source' else pair[1], e)
+                digests[pair][side] = digest
+                if side == 'source' and digest and self.cache is not None:
+                    self.cache.put(pair[0], digest, info[2])
+                if digests[pair]['source'] is not None and digests[pair]['target'] is not None:
+                    results.append(self._report(pair, digests[pair], errors[pair]))
+
+        return results
+
+    def _report(self, pair, digests, error=None):
+        result = {'source': pair[0],
+                  'target': pair[1],
+                  'source_digest': digests['source'],
+                  'target_digest': digests['target'],
+                  'error': error,
+                  'match': error is None and digests['source'] != '' and digests['source'] == digests['target']}
+        if self.result_callback is not None:
+            self.result_callback(result)
+        return result
+
+
+def print_result(result):
+    if result['error'] is not None:
+        print(("Could not verify {}: {}".format(basename(result['target']), result['error'])))
+    elif result['match']:
+        print(("sha256sum of target {} matches original: {}".format(basename(result['target']), result['source_digest'])))
+    else:
+        print(("sha256sum of {} does NOT match original. Original: {}, Target: {}".format(
+               result['source'], result['source_digest'], result['target_digest'])))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify ISOs on the USB against their sources.')
+    parser.add_argument('--cache', help='Digest cache file of the source ISOs')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes hashing source ISOs (default: number of CPUs)')
+    parser.add_argument('--target-concurrency', type=int, default=1,
+                        help='Number of ISOs read in parallel from the USB (default: 1)')
+    parser.add_argument('--target-dir', required=True, help='Mount point of the USB')
+    parser.add_argument('isos', nargs='+')
+    args = parser.parse_args()
+
+    print(("Check hash of {} ISOs...".format(len(args.isos))))
+    sys.stdout.flush()
+
+    # Report the verified bytes to the GUI's progress channel
+    channel = ProgressWriter.from_environment()
+    sizes = {}
+    for iso in args.isos:
+        try:
+            sizes[iso] = os.path.getsize(iso)
+        except OSError:
+            # Reported as failed by the verifier
+            sizes[iso] = 0
+    done = [0]
+    channel.emit({'phase': 'verify', 'bytes_done': 0, 'bytes_total': sum(sizes.values())})
+
+    def report(result):
+        print_result(result)
+        done[0] += sizes[result['source']]
+        channel.emit({'phase': 'verify',
+                      'event': 'result',
+                      'source': result['source'],
+                      'match': result['match'],
+                      'bytes_done': done[0],
+                      'bytes_total': sum(sizes.values())})
+
+    verifier = Verifier(cache_path=args.cache,
+                        source_workers=args.workers,
+                        target_concurrency=args.target_concurrency,
+                        result_callback=report)
+    pairs = [(iso, join(args.target_dir, basename(iso))) for iso in args.isos]
+    results = verifier.verify(pairs)
+    if [r for r in results if not r['match']]:
+        return EXIT_MISMATCH
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())